@@ -0,0 +1,138 @@
+"""
+Benchmark the wrangling, labeling and ML hot paths on synthetic collections.
+
+Usage (from the repository root):
+    python -m benchmarks.run_benchmarks --nodes 6 --rows 1000 5000 --files 4 --report bench.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from itertools import product
+
+import pandas as pd
+import pyarrow as pa
+
+from src.config import Config
+from src.data_wrangling import DataWrangle
+from src.data_transformation import DataTransformation
+from benchmarks.synthetic import SyntheticCollection
+
+class Benchmark:
+    """
+    Time (and optionally memory-profile with tracemalloc) each pipeline stage
+    for one synthetic collection configuration
+    """
+    def __init__(self, config: Config, logger, profile_memory=False):
+        self.config = config
+        self.logger = logger
+        self.profile_memory = profile_memory
+        self.results = []
+
+    def measure(self, stage: str, func, *args, **kwargs):
+        if self.profile_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        record = {
+            'stage': stage,
+            'seconds': round(elapsed, 6),
+            'max_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+        if self.profile_memory:
+            record['peak_traced_mib'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+            tracemalloc.stop()
+        if isinstance(result, pd.DataFrame):
+            record['rows'], record['columns'] = result.shape
+        self.results.append(record)
+        self.logger.info(f"[{stage}] {record}")
+        return result
+
+    def new_wrangler(self, dstdir: str):
+        return DataWrangle(self.config.config, self.config.y_map, logger=self.logger, dstdir=dstdir)
+
+    def run(self, file_names: list, workdir: str, scaler_pairs=[('standard', 'standard'), ('maxabs', 'minmax')]):
+        mno_file = next(fname for fname in file_names if 'mno' in os.path.basename(fname))
+
+        wrangler = self.new_wrangler(workdir)
+        self.measure('load_dataset', wrangler.load_dataset, mno_file)
+
+        # the raw frame is read before timing, each stage below only times its own work
+        wrangler = self.new_wrangler(workdir)
+        wrangler.df = pd.read_parquet(mno_file, engine='pyarrow').fillna(0)
+        self.measure('fix_node_ordering', lambda: (wrangler.fix_node_ordering(), wrangler.df)[1])
+        self.measure('feature_name_normalization', lambda: (wrangler.feature_name_normalization(), wrangler.df)[1])
+        self.measure('set_dtypes', lambda: (wrangler.set_dtypes(), wrangler.df)[1])
+        self.measure('randomize_nodes', lambda: (wrangler.randomize_nodes(), wrangler.df)[1])
+
+        wrangler = self.new_wrangler(workdir)
+        df = self.measure('load_and_combine_datasets',
+                          lambda: (wrangler.load_and_combine_datasets(file_names), wrangler.df)[1])
+
+        transformer = DataTransformation(wrangler.y_label_yellow, wrangler.y_label_red,
+                                         wrangler.y_label_red_fatal, logger=self.logger)
+        df = self.measure('impute_y_label', transformer.impute_y_label, df, label_weight=[0.02, 0.01, 0])
+        transformer.normalize_sources(df)
+        df = self.measure('get_clean_dataset', transformer.get_clean_dataset, df)
+
+        # imported here so the wrangling stages can be run without the ML dependencies
+        from src.custom_ml import CustomML
+        ml = self.measure('CustomML', CustomML, df.copy())
+        X, y = ml.get_xy_logreg("full")
+        from sklearn.model_selection import train_test_split
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=ml.split_size,
+                                                            random_state=ml.random_state)
+        self.measure('pipeline_transformer_logreg', ml.pipeline_transformer_logreg,
+                     X_train, y_train, X_test, y_test, scaler_pairs=scaler_pairs, silent=True)
+        return self.results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[6], help="Nodes in the mno clusters. (default 6)")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000], help="Rows per collection file. (default 1000)")
+    parser.add_argument("--files", type=int, nargs="+", default=[4], help="Collection files. (default 4)")
+    parser.add_argument("--etcd-suffix", nargs="+", default=["ip"], choices=["ip", "fqdn"], help="etcd column suffix style.")
+    parser.add_argument("--misorder", action="store_true", help="Place a control-plane node after the workers.")
+    parser.add_argument("--memory", action="store_true", help="Record tracemalloc peaks per stage (slower).")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--report", default="bench_report.json", help="Path of the JSON report.")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("benchmarks")
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper(),
+                        format='%(asctime)s [%(levelname)s] %(message)s')
+    config = Config(config_file="mapping/mapping.yaml", y_map_file="mapping/labels-definition.yaml", logger=logger)
+
+    report = {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pandas': pd.__version__,
+            'pyarrow': pa.__version__,
+        },
+        'runs': [],
+    }
+    for nodes, rows, files, etcd_suffix in product(args.nodes, args.rows, args.files, args.etcd_suffix):
+        params = {'nodes': nodes, 'rows': rows, 'files': files, 'etcd_suffix': etcd_suffix, 'misorder': args.misorder}
+        print(f"Running {params}", file=sys.stderr)
+        with tempfile.TemporaryDirectory() as workdir:
+            file_names = SyntheticCollection(seed=args.seed).generate(
+                os.path.join(workdir, "collection"), files=files, rows=rows, nodes=nodes,
+                etcd_suffix=etcd_suffix, misorder=args.misorder)
+            benchmark = Benchmark(config, logger, profile_memory=args.memory)
+            report['runs'].append({'params': params, 'stages': benchmark.run(file_names, os.path.join(workdir, "wrangle"))})
+
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.report}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
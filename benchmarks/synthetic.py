@@ -0,0 +1,103 @@
+import os
+import yaml
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+# probability of a y-label flag being set, per label color in labels-definition.yaml
+LABEL_RATES = {'yellow': 0.05, 'red': 0.02, 'red_fatal': 0.005}
+# node roles columns, only present for the nodes holding the role
+ROLE_COLUMNS = ('node0_control_plane', 'node0_master', 'node0_worker')
+# etcd columns whose names carry the member ip/fqdn instead of the node name
+ETCD_COLUMNS = ('node0_etcd_object_counts', 'node0_etcd_failed_proposal',
+                'node0_etcd_network_peer_rtt', 'node0_etcd_fsync_duration')
+
+class SyntheticCollection:
+    """
+    Generate synthetic cluster-telemetry collections (Parquet) matching mapping.yaml
+    and labels-definition.yaml, in the raw layout found under data/collection:
+        per-node features as node1_..nodeN_ columns
+        etcd features with the member ip (or fqdn) as suffix
+        run_id as %Y%m%d-%H%M%S strings and missing values as nulls
+    """
+    def __init__(self, mapping_file="mapping/mapping.yaml", y_map_file="mapping/labels-definition.yaml", seed=42):
+        with open(mapping_file, "r") as f:
+            self.mapping = yaml.safe_load(f)
+        with open(y_map_file, "r") as f:
+            self.y_map = yaml.safe_load(f)
+        self.label_rates = {entry['name']: LABEL_RATES.get(entry['label'], 0.0) for entry in self.y_map}
+        self.rng = np.random.default_rng(seed)
+
+    def etcd_suffix(self, idx: int, etcd_suffix: str):
+        ip = f"10_0_153_{80 + idx}"
+        if etcd_suffix == "fqdn":
+            return f"ip_{ip}_us_east_2_compute_internal"
+        return ip
+
+    def feature_column(self, name: str, dtype: str, rows: int, null_rate: float):
+        label = name.replace('node0_', '')
+        if dtype == "bool":
+            values = (self.rng.random(rows) < self.label_rates.get(label, 0.05)).astype(np.float64)
+        elif dtype == "uint32":
+            values = self.rng.integers(0, 500, rows).astype(np.float64)
+        else:
+            values = self.rng.random(rows) * 100
+        values[self.rng.random(rows) < null_rate] = np.nan
+        return values
+
+    def generate_frame(self, rows=1000, nodes=6, etcd_suffix="ip", misorder=False,
+                       start=datetime(2023, 8, 6), null_rate=0.02):
+        """
+        Return one raw collection DataFrame.
+
+        nodes           number of nodes, the first 3 hold the control-plane role
+        etcd_suffix     'ip' or 'fqdn' suffix for the etcd member columns
+        misorder        give the control-plane role to the last node instead of node3
+                        (exercises fix_node_ordering)
+        """
+        cp_nodes = [1, 2, 3]
+        if misorder and nodes > 3:
+            cp_nodes = [1, 2, nodes]
+        cols = {'run_id': [(start + timedelta(seconds=30 * i)).strftime("%Y%m%d-%H%M%S") for i in range(rows)]}
+
+        for entry in self.mapping:
+            for name in entry['names']:
+                if name in ('run_id', 'source') or name in ETCD_COLUMNS:
+                    continue
+                if name.startswith('node0_'):
+                    for node in range(1, nodes + 1):
+                        if name in ROLE_COLUMNS[:2] and node not in cp_nodes:
+                            continue
+                        if name == ROLE_COLUMNS[2] and node in cp_nodes and nodes > 3:
+                            continue
+                        colname = name.replace('node0', f'node{node}')
+                        cols[colname] = self.feature_column(name, entry['dtype'], rows, null_rate)
+                        if name in ROLE_COLUMNS:
+                            cols[colname] = np.ones(rows)
+                else:
+                    cols[name] = self.feature_column(name, entry['dtype'], rows, null_rate)
+
+        cols['total_qty_control_plane'] = self.rng.choice([1, 2, 3, 3, 3, 3, 3, 3], rows).astype(np.float64)
+        for idx, node in enumerate(cp_nodes):
+            suffix = self.etcd_suffix(idx, etcd_suffix)
+            cols[f'etcd_object_counts_{suffix}'] = self.rng.integers(0, 10000, rows).astype(np.float64)
+            cols[f'node{idx + 1}_etcd_failed_proposal_etcd_{self.etcd_suffix(idx, "fqdn")}'] = self.rng.random(rows)
+            cols[f'etcd_network_peer_rtt_{suffix}'] = self.rng.random(rows)
+            cols[f'etcd_fsync_duration_{suffix}'] = self.rng.random(rows)
+        return pd.DataFrame(cols)
+
+    def generate(self, dstdir: str, files=4, rows=1000, nodes=6, etcd_suffix="ip", misorder=False):
+        """
+        Write files collection files to dstdir, alternating compact (3 nodes) and mno (nodes) clusters.
+        Returns the list of file names.
+        """
+        os.makedirs(dstdir, exist_ok=True)
+        file_names = []
+        for idx in range(files):
+            compact = idx % 2 == 1
+            fname = os.path.join(dstdir, f"{'compact' if compact else 'mno'}-{idx:04d}.parquet")
+            self.generate_frame(rows=rows, nodes=3 if compact else nodes, etcd_suffix=etcd_suffix,
+                                misorder=misorder and not compact,
+                                start=datetime(2023, 8, 6) + timedelta(days=idx)).to_parquet(fname)
+            file_names.append(fname)
+        return file_names
@@ -1,10 +1,13 @@
+import sys
 import logging
 import argparse
-import inspect
 import pandas as pd
 from pathlib import Path
 from src.config import Config
 from src.data_wrangling import DataWrangle
+from src.data_transformation import DROP_COLUMNS
+from src.collection_filter import CollectionFilter, CLUSTER_TYPES
+from src.instrumentation import StageMetrics
 
 # TODO: Move extra functions to their own class
 def get_filenames(srcpath: str, logger):
@@ -19,28 +22,87 @@ def get_filenames(srcpath: str, logger):
     elif fname.is_dir():
         return list(fname.rglob("*.parquet"))
     else:
-        logger.error(f"[{inspect.stack()[0][3]}] {srcpath} is not a valid file or directory.")
+        logger.error(f"{srcpath} is not a valid file or directory.")
         return []
 
 def args_or_default(args, default):
     #if args != None:
     return args if args else default
 
+def selected_mode(args):
+    """
+    Return the mode selected by args, checked in the same order as main
+    """
+    for mode in ('validate', 'incremental', 'stream', 'arrow'):
+        if getattr(args, mode):
+            return mode
+    return 'default'
+
+def check_mode_options(parser, args, options, modes):
+    """
+    Exit with a usage error when any of options (argparse dests) is set in a mode outside
+    of modes, instead of accepting an option without effect
+    """
+    mode = selected_mode(args)
+    used = [f"--{option.replace('_', '-')}" for option in options if getattr(args, option)]
+    if used and mode not in modes:
+        names = [name if name == 'default' else f"--{name}" for name in (mode, *modes)]
+        parser.error(f"{', '.join(used)} not supported in {names[0]} mode (only in {', '.join(names[1:])}).")
+
 
 def main():
     # Parse command-line arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument("--validate", action="store_true", help="Only validate the mapping.")
+    parser.add_argument("--validate", action="store_true", help="Only validate the mapping against the source schemas (Parquet footers).")
     parser.add_argument("--mapping", help="dtypes mapping file to use. (default mapping/mapping.yaml)")
     parser.add_argument("--y-map", help="Mapping file for y-lables. (default mapping/labels-definitions.yaml)")
     parser.add_argument("--src", help="Path to source datasets (directory or file)")
     parser.add_argument("--dstfile", help="Path to write processed datasets (directory or file)")
+    parser.add_argument("--wrangle-cache", nargs="?", const="data/wrangle/cache",
+                        help="Reuse per-file wrangled outputs (Arrow IPC) from this directory. (default data/wrangle/cache)")
+    parser.add_argument("--plan-cache", help="Directory to persist the schema plans between runs. (default in-memory only)")
+    parser.add_argument("--mapping-cache", nargs="?", const="data/wrangle/cache",
+                        help="Keep the parsed and compiled mapping files in this directory between runs. (default data/wrangle/cache)")
+    parser.add_argument("--stream", action="store_true", help="Wrangle the sources batch by batch straight to the output file.")
+    parser.add_argument("--batch-size", type=int, default=65536, help="Rows per batch in --stream mode. (default 65536)")
+    parser.add_argument("--arrow", action="store_true", help="Wrangle the sources as Arrow tables without converting them to pandas.")
+    parser.add_argument("--incremental", action="store_true", help="Only wrangle new or changed sources into a partitioned dataset.")
+    parser.add_argument("--hash", action="store_true", help="Compare source content hashes in --incremental mode instead of only size and mtime.")
+    parser.add_argument("--partition", action="store_true", help="Write a hive-partitioned dataset by source, sorted by run_id.")
+    parser.add_argument("--partition-by-date", action="store_true", help="Also partition the output by run_id date.")
+    parser.add_argument("--compression", default="snappy", help="Parquet compression codec. (default snappy)")
+    parser.add_argument("--compression-level", type=int, help="Parquet compression level. (default codec level)")
+    parser.add_argument("--row-group-size", type=int, help="Maximum rows per Parquet row group.")
+    parser.add_argument("--long", action="store_true", help="Write the node-as-row layout (nodes.parquet and cluster.parquet in the dstfile directory).")
+    parser.add_argument("--compact", action="store_true", help="Write categoricals and downcast numeric columns to reduce memory.")
+    parser.add_argument("--dedup", action="store_true", help="Drop rows duplicated on the get_clean_dataset columns (default, --stream and --incremental modes).")
+    parser.add_argument("--drop", nargs="?", const=DROP_COLUMNS,
+                        help="Regex of normalized columns never read from the sources. (default the get_clean_dataset columns)")
+    parser.add_argument("--keep", help="Regex of normalized columns to read, all others are never read.")
+    parser.add_argument("--label-weight", type=float, nargs=3, metavar=("YELLOW", "RED", "RED_FATAL"),
+                        help="Impute y_label while loading, reading the label columns only for it.")
+    parser.add_argument("--source", nargs="+", help="Only load the sources matching these file name patterns (e.g. 'mno-*').")
+    parser.add_argument("--since", help="Only load run_ids at or after this time (YYYYmmdd-HHMMSS or ISO date/time).")
+    parser.add_argument("--until", help="Only load run_ids before this time (YYYYmmdd-HHMMSS or ISO date/time).")
+    parser.add_argument("--cluster-type", choices=list(CLUSTER_TYPES), help="Only load compact or mno sources.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to load the source datasets. (default 1)")
+    parser.add_argument("--metrics", help="Write per-stage timings, rows, bytes and peak RSS to this file (.json or .csv).")
     args = parser.parse_args()
+    check_mode_options(parser, args, ['source', 'since', 'until', 'cluster_type'], ['default', 'stream', 'arrow'])
+    check_mode_options(parser, args, ['drop', 'keep', 'label_weight'], ['default', 'stream'])
+    # compaction downcasts from the whole dataset (column maxima), not batch by batch
+    check_mode_options(parser, args, ['compact'], ['default'])
+    check_mode_options(parser, args, ['dedup'], ['default', 'stream', 'incremental'])
+    check_mode_options(parser, args, ['long', 'partition', 'partition_by_date'], ['default'])
+    check_mode_options(parser, args, ['row_group_size'], ['default', 'stream', 'arrow', 'incremental'])
+    if args.long and (args.partition or args.partition_by_date):
+        parser.error("--long writes its own layout, it cannot be combined with --partition or --partition-by-date.")
 
     # Load the general mapping
     global_config = Config(
         config_file=args_or_default(args.mapping,"mapping/mapping.yaml"), 
-        y_map_file=args_or_default(args.y_map,"mapping/labels-definition.yaml")
+        y_map_file=args_or_default(args.y_map,"mapping/labels-definition.yaml"),
+        cache_dir=args.mapping_cache
     )
     mapping = global_config.config
     logger = global_config.logger
@@ -49,13 +111,61 @@ def main():
     src = args_or_default(args.src,"data/collection")
     dstfile = args_or_default(args.dstfile,"dtyped-data.parquet")
 
+    metrics = StageMetrics(enabled=bool(args.metrics))
+    # column projection (default and --stream modes)
+    projection = {'drop': args.drop, 'keep': args.keep, 'label_weight': args.label_weight}
+    # source, run_id range and cluster type selection (default, --stream and --arrow modes)
+    row_filter = None
+    if args.source or args.since or args.until or args.cluster_type:
+        row_filter = CollectionFilter(sources=args.source, since=args.since, until=args.until,
+                                      cluster_type=args.cluster_type)
+
     # Create Data Wrangling instance
-    data_wrangler=DataWrangle(mapping, y_map_set=y_map, dstdir="data/wrangle", logger=logger)
+    data_wrangler=DataWrangle(mapping, y_map_set=y_map, dstdir="data/wrangle", logger=logger,
+                              plan_cache_dir=args.plan_cache, metrics=metrics,
+                              wrangle_cache_dir=args.wrangle_cache, compiled=global_config.compiled)
 
     file_names=get_filenames(src, logger)
     logger.info(f"Filenames {file_names}.")
-    data_wrangler.load_and_combine_datasets(file_names)
-    data_wrangler.write_dataset(dstfile)
+    if args.validate:
+        issues = data_wrangler.validate_schemas(file_names, workers=args.workers)
+        sys.exit(1 if issues else 0)
+    elif args.incremental:
+        data_wrangler.incremental_update(file_names, dstfile, use_hash=args.hash, workers=args.workers,
+                                         compression=args.compression, compression_level=args.compression_level,
+                                         dedup=args.dedup, row_group_size=args.row_group_size)
+    elif args.stream:
+        data_wrangler.stream_datasets(file_names, dstfile, batch_size=args.batch_size,
+                                      compression=args.compression, compression_level=args.compression_level,
+                                      dedup=args.dedup, row_filter=row_filter, row_group_size=args.row_group_size,
+                                      **projection)
+    elif args.arrow:
+        data_wrangler.load_and_combine_tables(file_names, row_filter=row_filter)
+        data_wrangler.write_table(dstfile, compression=args.compression,
+                                  compression_level=args.compression_level,
+                                  row_group_size=args.row_group_size)
+    else:
+        data_wrangler.load_and_combine_datasets(file_names, workers=args.workers, row_filter=row_filter,
+                                                dedup=args.dedup, **projection)
+        if args.compact:
+            data_wrangler.compact_dataset()
+        partitioned = args.partition or args.partition_by_date
+        if args.long:
+            data_wrangler.write_long_layout(dstfile, compression=args.compression,
+                                            compression_level=args.compression_level,
+                                            row_group_size=args.row_group_size)
+        else:
+            data_wrangler.write_dataset(dstfile,
+                                        partition_cols=['source'] if partitioned else None,
+                                        partition_by_date=args.partition_by_date,
+                                        compression=args.compression,
+                                        compression_level=args.compression_level,
+                                        row_group_size=args.row_group_size,
+                                        sort_by='run_id' if partitioned else None)
+
+    if args.metrics:
+        metrics.write(args.metrics)
+        logger.info(f"Stage metrics written to {args.metrics}.")
 
     logger.info(f"Taks {data_wrangler} completed.")
 
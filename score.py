@@ -0,0 +1,55 @@
+import sys
+import json
+import argparse
+from src.config import Config, Logger
+from src.scoring import Scorer
+from main import get_filenames, args_or_default
+
+def main():
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description="Score collection files or live snapshots with a saved model.")
+    parser.add_argument("--model", required=True, help="Model bundle written by CustomML.save_model.")
+    parser.add_argument("--mapping", help="dtypes mapping file to use. (default mapping/mapping.yaml)")
+    parser.add_argument("--y-map", help="Mapping file for y-lables. (default mapping/labels-definitions.yaml)")
+    parser.add_argument("--plan-cache", help="Directory to persist the schema plans between runs. (default in-memory only)")
+    parser.add_argument("--mapping-cache", nargs="?", const="data/wrangle/cache",
+                        help="Keep the parsed and compiled mapping files in this directory between runs. (default data/wrangle/cache)")
+    parser.add_argument("--src", help="Path to collection files to score (directory or file)")
+    parser.add_argument("--dstfile", help="Parquet file to write the scores to. (default data/wrangle/scores.parquet)")
+    parser.add_argument("--batch-size", type=int, default=65536, help="Rows per scoring batch. (default 65536)")
+    parser.add_argument("--snapshot", help="JSON lines file of raw snapshots ({column: value}) to score, '-' for stdin.")
+    args = parser.parse_args()
+
+    # Load the general mapping (no banner, stdout carries the snapshot scores)
+    global_config = Config(
+        config_file=args_or_default(args.mapping,"mapping/mapping.yaml"),
+        y_map_file=args_or_default(args.y_map,"mapping/labels-definition.yaml"),
+        logger=Logger(show_message=False).logger,
+        cache_dir=args.mapping_cache
+    )
+    logger = global_config.logger
+
+    scorer = Scorer(args.model, global_config.config, global_config.y_map, logger=logger,
+                    plan_cache_dir=args.plan_cache, compiled=global_config.compiled)
+
+    if args.snapshot:
+        # one result per snapshot line, flushed as soon as it is scored
+        stream = sys.stdin if args.snapshot == "-" else open(args.snapshot, "r")
+        with stream:
+            for line in stream:
+                if line.strip():
+                    try:
+                        result = scorer.score_snapshot(json.loads(line))
+                    except ValueError as e:
+                        # a malformed snapshot is reported in its place, the next ones are still scored
+                        logger.warning(f"Snapshot not scored. {e}")
+                        result = {'error': str(e)}
+                    print(json.dumps(result), flush=True)
+    else:
+        file_names = get_filenames(args_or_default(args.src,"data/collection"), logger)
+        dstfile = args_or_default(args.dstfile,"data/wrangle/scores.parquet")
+        rows = scorer.score_files(file_names, dstfile, batch_size=args.batch_size)
+        logger.info(f"Scored {rows} rows from {len(file_names)} files to {dstfile}.")
+
+if __name__ == "__main__":
+    main()
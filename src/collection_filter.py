@@ -0,0 +1,126 @@
+import re
+import fnmatch
+import operator
+from functools import reduce
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S"
+# source name patterns of each cluster type (see DataTransformation.normalize_sources)
+CLUSTER_TYPES = {
+    'compact': 'compact|promql',
+    'mno': 'mno',
+}
+
+def run_id_string(value):
+    """
+    Return value (TIMESTAMP_FORMAT string, ISO date/time string or datetime) as a raw
+    run_id string, which sorts like the time it stands for
+    """
+    if isinstance(value, str) and re.fullmatch(r"\d{8}-\d{6}", value):
+        return value
+    return pd.Timestamp(value).strftime(TIMESTAMP_FORMAT)
+
+def like_pattern(pattern: str):
+    """
+    Return the SQL LIKE pattern (pyarrow.compute.match_like) of a fnmatch pattern
+    """
+    return re.sub(r"([%_\\])", r"\\\1", pattern).replace('*', '%').replace('?', '_')
+
+class CollectionFilter:
+    """
+    Selection of the collection rows to load:
+        sources         source file name patterns (fnmatch, e.g. "mno-*.parquet")
+        since, until    run_id time range, since inclusive and until exclusive
+        cluster_type    'compact' or 'mno', matched on the source name as normalize_sources
+
+    Sources and cluster type are checked on the file name first and the run_id range on the
+    Parquet row group statistics, so non-matching files are never opened for reading.
+    The remaining conditions are pushed into the pyarrow scan as a filter expression,
+    which skips the row groups outside the range and filters the rows of the others.
+    """
+    def __init__(self, sources=None, since=None, until=None, cluster_type=None):
+        if cluster_type is not None and cluster_type not in CLUSTER_TYPES:
+            raise ValueError(f"Unknown cluster type {cluster_type}. Use one of {list(CLUSTER_TYPES)}.")
+        self.sources = list(sources) if sources else None
+        self.since = run_id_string(since) if since is not None else None
+        self.until = run_id_string(until) if until is not None else None
+        self.cluster_type = cluster_type
+
+    def __repr__(self):
+        return (f"CollectionFilter(sources={self.sources}, since={self.since}, until={self.until}, "
+                f"cluster_type={self.cluster_type})")
+
+    def match_source(self, source: str):
+        """
+        True when the source name passes the sources and cluster type conditions
+        """
+        if self.sources and not any(fnmatch.fnmatch(source, pattern) for pattern in self.sources):
+            return False
+        if self.cluster_type and not re.search(CLUSTER_TYPES[self.cluster_type], source, flags=re.IGNORECASE):
+            return False
+        return True
+
+    def run_id_bounds(self, arrow_type):
+        """
+        Return (since, until) as scalars comparable with a run_id column of arrow_type
+        """
+        if pa.types.is_timestamp(arrow_type):
+            convert = lambda value: pa.scalar(pd.to_datetime(value, format=TIMESTAMP_FORMAT), type=arrow_type)
+        else:
+            convert = lambda value: pa.scalar(value, type=arrow_type)
+        return (convert(self.since) if self.since else None,
+                convert(self.until) if self.until else None)
+
+    def expression(self, schema: pa.Schema):
+        """
+        Return the row filter (pyarrow.dataset.Expression) for a file or dataset of schema,
+        None when no condition applies to its columns
+        """
+        conditions = []
+        if 'run_id' in schema.names and (self.since or self.until):
+            since, until = self.run_id_bounds(schema.field('run_id').type)
+            if since is not None:
+                conditions.append(ds.field('run_id') >= since)
+            if until is not None:
+                conditions.append(ds.field('run_id') < until)
+        if 'source' in schema.names:
+            # sources stored in the data (or as hive partitions) instead of the file name
+            if self.sources:
+                conditions.append(reduce(operator.or_, [pc.match_like(ds.field('source'), like_pattern(pattern))
+                                                         for pattern in self.sources]))
+            if self.cluster_type:
+                conditions.append(pc.match_substring_regex(ds.field('source'), CLUSTER_TYPES[self.cluster_type],
+                                                           ignore_case=True))
+        return reduce(operator.and_, conditions) if conditions else None
+
+    def may_match(self, fname: str):
+        """
+        True unless the footer statistics show that no row group of fname is in the run_id range
+        """
+        if not (self.since or self.until):
+            return True
+        metadata = pq.ParquetFile(fname).metadata
+        schema = metadata.schema.to_arrow_schema()
+        if 'run_id' not in schema.names:
+            return True
+        position = schema.get_field_index('run_id')
+        since, until = (bound.as_py() if bound is not None else None
+                        for bound in self.run_id_bounds(schema.field('run_id').type))
+        for row_group in range(metadata.num_row_groups):
+            statistics = metadata.row_group(row_group).column(position).statistics
+            if statistics is None or not statistics.has_min_max:
+                return True
+            if (since is None or statistics.max >= since) and (until is None or statistics.min < until):
+                return True
+        return False
+
+    def select_files(self, file_names: list):
+        """
+        Return the files of file_names that can hold selected rows
+        """
+        return [fname for fname in file_names
+                if self.match_source(str(fname).split('/')[-1]) and self.may_match(fname)]
@@ -2,19 +2,124 @@
 import yaml
 import logging
 import os
+import pickle
+import hashlib
+from .schema_plan import mapping_hash
+from .file_utils import file_hash, atomic_write
+
+# libyaml loader when PyYAML was built with it
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+def compile_dtypes(mapping_set):
+    """
+    Return {feature name: dtype} of a loaded mapping (mapping.yaml)
+    """
+    dtypes_maps = {}
+    for entry in mapping_set:
+        for item in entry['names']:
+            dtypes_maps[item] = entry['dtype']
+    return dtypes_maps
+
+def compile_y_label_maps(y_map_set):
+    """
+    Return {'y_label_maps': {name: label}, 'yellow': [...], 'red': [...], 'red_fatal': [...]}
+    of a loaded y-map (labels-definition.yaml)
+    """
+    compiled = {'y_label_maps': {}, 'yellow': [], 'red': [], 'red_fatal': []}
+    for entry in y_map_set:
+        compiled['y_label_maps'][entry['name']] = entry['label']
+        if entry['label'] in ('yellow', 'red', 'red_fatal'):
+            compiled[entry['label']].append(entry['name'])
+    return compiled
+
+def compile_mapping(config, y_map):
+    """
+    Return the lookup tables DataWrangle builds from the mapping and y-map, with their hashes
+    """
+    return {
+        'dtypes_maps': compile_dtypes(config),
+        'y_labels': compile_y_label_maps(y_map),
+        'mapping_hash': mapping_hash(config),
+        'labels_hash': mapping_hash(y_map),
+    }
 
 class Config:
-    def __init__(self, config_file, y_map_file, logger=None):
+    """
+    Load the mapping and y-map YAML files.
+
+    With cache_dir, the parsed files and their compiled lookup tables (see compile_mapping)
+    are kept in a pickle keyed by the file paths. The cache is used while the size and mtime
+    of both files are unchanged, or while their content hash is (e.g. after a checkout), so
+    a process can start with the tables ready without parsing YAML.
+    """
+    def __init__(self, config_file, y_map_file, logger=None, cache_dir=None):
         self.config_file = config_file
         self.y_map_file = y_map_file
         self.logger = logger if logger else Logger().logger
-        self.config = self.load_config()
-        self.y_map = self.load_y_map()
+        self.cache_dir = cache_dir
+        self.compiled = None
+        if not self.load_cached():
+            self.config = self.load_config()
+            self.y_map = self.load_y_map()
+            if self.config is not None and self.y_map is not None:
+                self.compiled = compile_mapping(self.config, self.y_map)
+                self.save_cached()
+
+    def cache_path(self):
+        key = hashlib.sha256(f"{os.path.abspath(self.config_file)}:{os.path.abspath(self.y_map_file)}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"mapping-{key[:16]}.pickle")
+
+    def file_signatures(self, stored=None):
+        """
+        Return {file: {size, mtime_ns, sha256}}. The content hash is reused from stored
+        when size and mtime match.
+        """
+        signatures = {}
+        for fname in (self.config_file, self.y_map_file):
+            stat = os.stat(fname)
+            signature = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            previous = (stored or {}).get(fname)
+            if previous and previous['size'] == signature['size'] and previous['mtime_ns'] == signature['mtime_ns']:
+                signature['sha256'] = previous['sha256']
+            else:
+                signature['sha256'] = file_hash(fname)
+            signatures[fname] = signature
+        return signatures
+
+    def load_cached(self):
+        """
+        Load config, y_map and compiled from the cache. Returns False when disabled or stale.
+        """
+        if not self.cache_dir or not os.path.exists(self.cache_path()):
+            return False
+        try:
+            with open(self.cache_path(), "rb") as f:
+                cached = pickle.load(f)
+            signatures = self.file_signatures(cached['files'])
+        except Exception as e:
+            self.logger.warning(f"Ignoring the mapping cache due to {str(e)}")
+            return False
+        if any(signatures[fname]['sha256'] != cached['files'][fname]['sha256'] for fname in signatures):
+            return False
+        self.config, self.y_map, self.compiled = cached['config'], cached['y_map'], cached['compiled']
+        if signatures != cached['files']:
+            # same content, new mtime: refresh the signatures so the next start skips hashing
+            self.save_cached(signatures)
+        self.logger.info("Loaded the config and y-map from the mapping cache.")
+        return True
+
+    def save_cached(self, signatures=None):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with atomic_write(self.cache_path()) as tmp, open(tmp, "wb") as f:
+            pickle.dump({'files': signatures or self.file_signatures(), 'config': self.config,
+                         'y_map': self.y_map, 'compiled': self.compiled}, f, protocol=pickle.HIGHEST_PROTOCOL)
 
     def load_config(self):
         try:
             with open(self.config_file, "r") as f:
-                config = yaml.safe_load(f)
+                config = yaml.load(f, Loader=SafeLoader)
                 self.logger.info("Successfully loaded the config YAML file.")
                 return config
         except Exception as e:
@@ -24,7 +129,7 @@ class Config:
     def load_y_map(self):
         try:
             with open(self.y_map_file, "r") as f:
-                y_map = yaml.safe_load(f)
+                y_map = yaml.load(f, Loader=SafeLoader)
                 self.logger.info("Successfully loaded the y-map YAML file.")
                 return y_map
         except Exception as e:
@@ -32,13 +137,18 @@ class Config:
             return None
 
 class Logger:
+    # the banner is printed and the handler added once per process
+    banner_shown = False
+
     def __init__(self, show_message=True):
         msg=f"""
         #######################################################################################################
             For controlling verbosity of messages set LOG_LEVEL environment variable (e.g., INFO, DEBUG)
         #######################################################################################################
         """
-        if show_message: print(msg)
+        if show_message and not Logger.banner_shown:
+            print(msg)
+            Logger.banner_shown = True
 
         # Create a logger
         self.logger = logging.getLogger(__name__)
@@ -47,12 +157,20 @@ class Logger:
         log_level = os.getenv("LOG_LEVEL", "INFO").upper()
         self.logger.setLevel(log_level)
 
+        # reuse the handler of an earlier Logger instead of logging every message twice
+        for handler in self.logger.handlers:
+            if getattr(handler, 'config_handler', False):
+                handler.setLevel(log_level)
+                return
+
         # Create console handler with a higher log level
         ch = logging.StreamHandler()
+        ch.config_handler = True
         ch.setLevel(log_level)
 
         # Create a formatter and add it to the handlers
-        formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+        # the calling function comes from the log record instead of inspect.stack() per call
+        formatter = logging.Formatter('%(asctime)s [%(levelname)s] [%(funcName)s] %(message)s')
         ch.setFormatter(formatter)
 
         # Add the handlers to the logger
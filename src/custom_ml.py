@@ -1,5 +1,11 @@
 # general libraries
 
+import os
+import json
+import hashlib
+from itertools import product
+from collections.abc import MutableMapping
+
 # common data manipulation libraries
 import pandas as pd
 import numpy as np
@@ -8,45 +14,118 @@ import warnings
 # to suppress numpy warnings
 warnings.filterwarnings('ignore')
 
-# loading common ML libraries and setting defaults
-from sklearn.linear_model import LogisticRegression
-from sklearn.cluster import KMeans
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.pipeline import Pipeline
-from sklearn.compose import ColumnTransformer
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import (
-    ConfusionMatrixDisplay,
-    f1_score,
-    accuracy_score,
-    balanced_accuracy_score,
-    average_precision_score,
-    precision_score,
-    recall_score,
-    brier_score_loss,
-    mean_squared_error
-)
-
-from sklearn.preprocessing import (
-    MaxAbsScaler,
-    MinMaxScaler,
-    PowerTransformer,
-    StandardScaler
-)
-
-# plotting library
-import matplotlib as mpl
-from matplotlib import cm
-import matplotlib.pyplot as plt
+# ML (sklearn, joblib) and plotting (matplotlib) libraries are imported where they are
+# used, so importing this module (e.g. for model_scores) stays cheap
+
+from .sparse_features import SparseFeatures
+from .file_utils import atomic_write
+
+def fit_score(model, X_train, y_train, X_test, y_test):
+    """
+    Fit a fresh copy of model and return its score on the test set (joblib task)
+    """
+    from sklearn.base import clone
+    return clone(model).fit(X_train, y_train).score(X_test, y_test)
+
+def model_scores(y_truth, y_pred):
+    from sklearn.metrics import (
+        f1_score,
+        accuracy_score,
+        balanced_accuracy_score,
+        precision_score,
+        recall_score,
+        mean_squared_error
+    )
+    return {
+        'accuracy_score': accuracy_score(y_truth, y_pred),
+        'balanced_accuracy_score': balanced_accuracy_score(y_truth, y_pred),
+        'f1_score': f1_score(y_truth, y_pred, average='macro'),
+        'precision_score': precision_score(y_truth, y_pred, average='macro'),
+        'recall_score': recall_score(y_truth, y_pred, average='macro'),
+        'mean_squared_error': mean_squared_error(y_truth, y_pred),
+    }
+
+def fit_evaluate(model, X_train, y_train, X_test, y_test):
+    """
+    Fit a fresh copy of model and return its scores and confusion matrix on the test set (joblib task)
+    """
+    from sklearn.base import clone
+    from sklearn.metrics import confusion_matrix
+    y_pred = clone(model).fit(X_train, y_train).predict(X_test)
+    labels = np.union1d(np.unique(y_test), np.unique(y_pred))
+    return {
+        'scores': model_scores(y_test, y_pred),
+        'labels': labels.tolist(),
+        'confusion_matrix': confusion_matrix(y_test, y_pred, labels=labels).tolist(),
+    }
+
+class ClusterSplit(MutableMapping):
+    """
+    Per cluster type datasets of a CustomML instance, as row positions into its X_data.
+
+    Keys 'X_full', 'X', 'y', 'X_train', 'y_train', 'X_test' and 'y_test' are materialized
+    on access from the shared X_data, so no copy is held per cluster type. Other keys
+    (e.g. a re-encoded 'y_train_logreg') can be assigned and are stored as given.
+    """
+    KEYS = ('X_full', 'X', 'y', 'X_train', 'y_train', 'X_test', 'y_test')
+
+    def __init__(self, ml, rows):
+        self.ml = ml
+        self.rows = rows
+        self.train_idx = None
+        self.test_idx = None
+        self.extra = {}
+
+    def __getitem__(self, key):
+        if key in self.extra:
+            return self.extra[key]
+        match key:
+            case 'X_full':
+                return self.ml.X_data.iloc[self.rows]
+            case 'X':
+                return self.ml.X_rows(self.rows)
+            case 'y':
+                return self.ml.X_data['y_label'].iloc[self.rows]
+            case 'X_train':
+                return self.ml.X_rows(self.train_idx)
+            case 'X_test':
+                return self.ml.X_rows(self.test_idx)
+            case 'y_train':
+                return self.ml.X_data['y_label'].iloc[self.train_idx]
+            case 'y_test':
+                return self.ml.X_data['y_label'].iloc[self.test_idx]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.extra[key] = value
+
+    def __delitem__(self, key):
+        del self.extra[key]
+
+    def __iter__(self):
+        yield from self.KEYS
+        yield from (key for key in self.extra if key not in self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS) + len([key for key in self.extra if key not in self.KEYS])
+
+    def keys(self):
+        return dict.fromkeys(self).keys()
 
 class CustomML:
     def __init__(self, X_data: pd.DataFrame, random_state=42, split_size=0.25) -> None:
-        self.X_data=X_data.copy().drop(['cluster_magic_split'], axis=1)                     
+        # drop returns a new frame and encode_y assigns a new y_label column, so the
+        # caller's frame is not modified
+        self.X_data=X_data.drop(['cluster_magic_split'], axis=1)
         self.encode_y()
         # to store per-custer data
         self.X_cluster = self.define_X_cluster()
         self.random_state=random_state
         self.split_size=split_size
+        # scaled train/test blocks per split and scaler (see scaled_matrices)
+        self.scaled_cache={}
+        # CSR matrix of X built on first use (see sparse_X)
+        self._sparse_X=None
 
         self.split_xy()
         self.split_xy_by_cluster_type()
@@ -61,80 +140,90 @@ class CustomML:
             1 = red
             2 = yellow
         """
-        self.X_data.loc[self.X_data['y_label'] == "green",  ['y_label']]=0
-        self.X_data.loc[self.X_data['y_label'] == "red",    ['y_label']]=1
-        self.X_data.loc[self.X_data['y_label'] == "yellow", ['y_label']]=2
+        # encode into a copy: categorical (compact datasets) or string y_label cannot hold
+        # the numeric codes, and writing in place could reach the caller's frame
+        y_label = self.X_data['y_label'].to_numpy(dtype=object, copy=True)
+        y_label[y_label == "green"] = 0
+        y_label[y_label == "red"] = 1
+        y_label[y_label == "yellow"] = 2
+        self.X_data['y_label'] = pd.Series(y_label, index=self.X_data.index, dtype=object)
 
     def define_X_cluster(self):
         X_cluster = {
-            'compact':{
-                'X_full':None,
-                'X':None, 
-                'y': None, 
-                'X_train': None, 
-                'y_train': None, 
-                'X_test': None, 
-                'y_test': None
-            },
-            'mno':{
-                'X_full':None,
-                'X':None, 
-                'y': None, 
-                'X_train': None, 
-                'y_train': None, 
-                'X_test': None, 
-                'y_test': None
-            }
-        } 
+            'compact': ClusterSplit(self, None),
+            'mno': ClusterSplit(self, None)
+        }
         return X_cluster
 
     def split_by_cluster_type(self):
         """
-        Create an dataset per cluster type
+        Select the rows of each cluster type
         """
-        self.X_cluster['compact']['X_full'] = self.X_data[self.X_data['source'] == 'compact']
-        self.X_cluster['mno']['X_full']     = self.X_data[self.X_data['source'] == 'mno']
+        for cluster in self.X_cluster.keys():
+            self.X_cluster[cluster].rows = np.flatnonzero(self.X_data['source'].to_numpy() == cluster)
 
         print(f"Compact cluster {self.X_cluster['compact']['X_full'].shape}"+
               f"\nMultinode (mno) {self.X_cluster['mno']['X_full'].shape}")
 
     def split_xy_by_cluster_type(self):
         """
-        Create an X and y per cluster type and the corresponding train_test_split
+        Create the train_test_split row positions per cluster type
         """
-        if self.X_cluster['compact']['X_full'] is None:
+        from sklearn.model_selection import train_test_split
+        if self.X_cluster['compact'].rows is None:
             self.split_by_cluster_type()
 
-        self.X_cluster['compact']['X'] = self.X_cluster['compact']['X_full'].drop(['source','y_label'], axis=1)
-        self.X_cluster['compact']['y'] = self.X_cluster['compact']['X_full']['y_label']
+        for cluster in self.X_cluster.keys():
+            split = self.X_cluster[cluster]
+            split.train_idx, split.test_idx = train_test_split(split.rows,
+                                                               test_size=self.split_size,
+                                                               random_state=self.random_state)
 
-        self.X_cluster['mno']['X'] = self.X_cluster['mno']['X_full'].drop(['source','y_label'], axis=1)
-        self.X_cluster['mno']['y'] = self.X_cluster['mno']['X_full']['y_label']
+    def split_xy(self):
+        """
+        Create the train_test_split row positions of the full dataset
+        """
+        from sklearn.model_selection import train_test_split
+        self.train_idx, self.test_idx = train_test_split(np.arange(self.X_data.shape[0]),
+                                                         test_size=self.split_size,
+                                                         random_state=self.random_state)
 
-        for cluster in self.X_cluster.keys():
-            X_train, X_test, y_train, y_test = train_test_split(self.X_cluster[cluster]['X'], 
-                                                                self.X_cluster[cluster]['y'], 
-                                                                test_size=self.split_size, 
-                                                                random_state=self.random_state)
-            self.X_cluster[cluster]['X_train'] = X_train
-            self.X_cluster[cluster]['X_test']  = X_test
-            self.X_cluster[cluster]['y_train'] = y_train
-            self.X_cluster[cluster]['y_test']  = y_test
+    # X, y and their splits are materialized on access from X_data
+    @property
+    def X(self):
+        return self.X_data.drop(['source','y_label'], axis=1)
 
+    @property
+    def y(self):
+        return self.X_data['y_label'].astype('uint32')
 
-    def split_xy(self):
+    def X_rows(self, rows):
         """
-        Create a X_full and y_full
+        X at the row positions rows, selecting the rows before dropping the label columns
+        so only the selected rows are copied
         """
-        self.X = self.X_data.drop(['source','y_label'], axis=1)
-        self.y = self.X_data['y_label'].astype('uint32')
+        return self.X_data.iloc[rows].drop(['source','y_label'], axis=1)
+
+    @property
+    def X_train(self):
+        return self.X_rows(self.train_idx)
 
-        self.X_train, self.X_test, self.y_train, self.y_test = train_test_split(
-            self.X, self.y, test_size=self.split_size, random_state=self.random_state)
+    @property
+    def X_test(self):
+        return self.X_rows(self.test_idx)
+
+    @property
+    def y_train(self):
+        return self.y.iloc[self.train_idx]
+
+    @property
+    def y_test(self):
+        return self.y.iloc[self.test_idx]
 
     def get_dataset(self, dataset_type="full"):
         """
-        return dataset_type
+        return dataset_type. The frame shares its data with X_data: assign new columns or
+        Series instead of modifying it in place (e.g. with .loc).
 
         dataset_type
             "full"    uses the full dataset X_data
@@ -143,18 +232,46 @@ class CustomML:
         """
         match dataset_type:
             case "full":
-                df=self.X_data.copy()
-            case "compact":
-                df=self.X_cluster['compact']['X'].copy()
-            case "mno":
-                df=self.X_cluster['compact']['mno'].copy()
+                df=self.X_data.copy(deep=False)
+            case "compact" | "mno":
+                df=self.X_cluster[dataset_type]['X_full']
             case _:
                 print(f"Invalid dataset_type")
                 return None
         return df
     
+    def sparse_X(self):
+        """
+        Return X as SparseFeatures, built once per instance
+        """
+        if self._sparse_X is None:
+            self._sparse_X=SparseFeatures.from_frame(self.X)
+            print(f"Sparse X {self._sparse_X.shape} with {self._sparse_X.nnz} non-zeros "
+                  f"(density {self._sparse_X.density():.3f}, {self._sparse_X.nbytes()/2**20:.1f} MiB)")
+        return self._sparse_X
+
+    def get_sparse_xy(self, dataset_type="full", binary=False):
+        """
+        return X_train, X_test (SparseFeatures) and y_train, y_test of the same split as
+        X_train/X_test (dataset_type "full") or X_cluster[dataset_type] ("compact", "mno").
+        With binary, yellow is merged into red as in get_xy_logreg.
+        """
+        match dataset_type:
+            case "full":
+                train_idx, test_idx = self.train_idx, self.test_idx
+            case "compact" | "mno":
+                train_idx, test_idx = self.X_cluster[dataset_type].train_idx, self.X_cluster[dataset_type].test_idx
+            case _:
+                print(f"Invalid dataset_type")
+                return None
+        X=self.sparse_X()
+        y=self.y
+        if binary:
+            y=(y > 0).astype('uint32')
+        return X.take(train_idx), X.take(test_idx), y.iloc[train_idx], y.iloc[test_idx]
+
     def get_xy_by_cluster_type(self):
-        if self.X_cluster['compact']['X'] is None:
+        if self.X_cluster['compact'].train_idx is None:
             self.split_xy_by_cluster_type()
         return self.X_cluster
 
@@ -170,17 +287,55 @@ class CustomML:
         df=self.get_dataset(dataset_type)
 
         # Default datasets encoding: 0 = green, 1 = red, 2 = yellow
-        # Chaning any yellow to 'red' encoded as 1
-        df.loc[df['y_label'] == 2, ['y_label']]=1
+        # Chaning any yellow to 'red' encoded as 1, as a new Series: df shares its data with X_data
+        y_label = df['y_label'].where(df['y_label'] != 2, 1)
         
-        print(f"{df['y_label'].value_counts()}")
+        print(f"{y_label.value_counts()}")
 
         # Get our full logreg X and y
         X_logreg = df.drop(['source','y_label'], axis=1)
-        y_logreg = df['y_label'].astype('boolean')
+        y_logreg = y_label.astype('boolean')
 
         return X_logreg,y_logreg
 
+    def make_scaler(self, scaler, sparse=False):
+        """
+        Return a new scaling pipeline: 'standard', 'maxabs', 'minmax' or 'power'.
+        With sparse, only the scalers keeping zeros at zero: 'standard' (without centering)
+        and 'maxabs'.
+        """
+        from sklearn.pipeline import Pipeline
+        from sklearn.preprocessing import MaxAbsScaler, MinMaxScaler, PowerTransformer, StandardScaler
+        if sparse:
+            match scaler:
+                case 'standard':
+                    return Pipeline([('scaler', StandardScaler(with_mean=False))])
+                case 'maxabs':
+                    return Pipeline([('maxabs', MaxAbsScaler())])
+                case _:
+                    raise ValueError(f"Scaler {scaler} does not support sparse input. Use 'standard' or 'maxabs'.")
+        match scaler:
+            case 'standard':
+                return Pipeline([('scaler', StandardScaler())])
+            case 'maxabs':
+                return Pipeline([('maxabs', MaxAbsScaler())])
+            case 'minmax':
+                return Pipeline([('minmax', MinMaxScaler(feature_range=(0,1)))])
+            case 'power':
+                return Pipeline([('power', PowerTransformer(method='yeo-johnson'))])
+            case _:
+                raise KeyError(scaler)
+
+    def columns_per_type(self, df):
+        """
+        Return the (uint32, float64) column lists scaled by feature_scaling_per_type
+        (column positions for SparseFeatures)
+        """
+        if isinstance(df, SparseFeatures):
+            return df.select_dtypes([np.unsignedinteger]), df.select_dtypes([np.floating])
+        return (df.select_dtypes(include=[np.unsignedinteger]).columns.to_list(),
+                df.select_dtypes(include=[np.floating]).columns.to_list())
+
     def feature_scaling_per_type(self, df, scaler_uint32='standard', scaler_float64='standard'):
         """
         https://scikit-learn.org/stable/modules/classes.html#module-sklearn.preprocessing
@@ -190,75 +345,102 @@ class CustomML:
             'maxabs'    | MaxAbsScaler
             'minmax'    | MinMaxScaler
             'power'     | PowerTransformer
+
+        For SparseFeatures (see get_sparse_xy) the transformer works on the column positions,
+        uses the sparse-safe scalers ('standard' without centering, 'maxabs') and keeps the
+        output sparse. Fit it on X.matrix.
         """
         #print(f"Scaling dataset. Make sure to have the train and test split BEFORE the scaling")
+        from sklearn.compose import ColumnTransformer
+        cols_uint32, cols_float64 = self.columns_per_type(df)
+        is_sparse = isinstance(df, SparseFeatures)
 
-        # pipeline to transform uint32 features
-        # These features represent an absolute value (e.g. num of Pods)
-        pipe_uint32 = { 
-            'standard' : Pipeline([
-                ('scaler', StandardScaler())
-                ]), 
-            'maxabs' : Pipeline([
-                ('maxabs', MaxAbsScaler())
-                ]),
-            'minmax' : Pipeline([
-                ('minmax', MinMaxScaler(feature_range=(0,1)))
-                ]),
-            'power' : Pipeline([
-                ('power', PowerTransformer(method='yeo-johnson'))
-                ])
-        }
-
-        # pipeline to transform float64 features
-        # These features represent a percentages, transaction rates
-        pipe_float64 = { 
-            'standard' : Pipeline([
-                ('scaler', StandardScaler())
-                ]), 
-            'maxabs' : Pipeline([
-                ('maxabs', MaxAbsScaler())
-                ]),
-            'minmax' : Pipeline([
-                ('minmax', MinMaxScaler(feature_range=(0,1)))
-                ]),
-            'power' : Pipeline([
-                ('power', PowerTransformer(method='yeo-johnson'))
-                ])
-        }
-
+        # uint32 features represent an absolute value (e.g. num of Pods)
+        # float64 features represent a percentages, transaction rates
         ct = ColumnTransformer([
-                (
-                    'scaler_uint32', pipe_uint32[scaler_uint32],
-                    df.select_dtypes(include=['uint32']).columns.to_list()
-                ),
-                (
-                    'scaler_float64', pipe_float64[scaler_float64], 
-                    df.select_dtypes(include=['float64']).columns.to_list()
-                )
-            ])
+                ('scaler_uint32', self.make_scaler(scaler_uint32, is_sparse), cols_uint32),
+                ('scaler_float64', self.make_scaler(scaler_float64, is_sparse), cols_float64)
+            ], sparse_threshold=1.0 if is_sparse else 0.3)
 
         return ct
 
-    def pipeline_transformer_logreg(self, X_train, y_train, X_test, y_test, scaler_pairs=[('standard','standard')], silent=False):
+    def split_key(self, X_train, X_test):
+        """
+        Content fingerprint of a train/test split (index, columns and values)
         """
+        digest=hashlib.sha256()
+        for df in (X_train, X_test):
+            if isinstance(df, SparseFeatures):
+                digest.update(str([(colname, df.dtypes[colname]) for colname in df.columns]).encode())
+                for values in (df.index, df.matrix.indptr, df.matrix.indices, df.matrix.data):
+                    digest.update(np.ascontiguousarray(values).tobytes())
+                continue
+            digest.update(str(list(zip(df.columns, df.dtypes.astype(str)))).encode())
+            digest.update(pd.util.hash_pandas_object(df).to_numpy().tobytes())
+        return digest.hexdigest()
+
+    def scaled_matrices(self, X_train, X_test, scaler_uint32='standard', scaler_float64='standard', key=None):
+        """
+        Return the (X_train, X_test) arrays scaled like feature_scaling_per_type.
 
+        Each (dtype group, scaler) is fit once per split and its train/test blocks are cached
+        in self.scaled_cache, so scaler pairs and models sharing a split reuse them.
+        Pass key (from split_key) to skip fingerprinting the split again.
+        SparseFeatures splits are scaled with the sparse-safe scalers into CSR matrices.
+        """
+        is_sparse = isinstance(X_train, SparseFeatures)
+        key = key if key else self.split_key(X_train, X_test)
+        if key not in self.scaled_cache:
+            self.scaled_cache[key] = {'columns': self.columns_per_type(X_train)}
+        cache = self.scaled_cache[key]
+
+        blocks = []
+        for group, cols, scaler in (('uint32', cache['columns'][0], scaler_uint32),
+                                    ('float64', cache['columns'][1], scaler_float64)):
+            if (group, scaler) not in cache:
+                if cols and is_sparse:
+                    train, test = X_train.block(cols), X_test.block(cols)
+                    pipe = self.make_scaler(scaler, sparse=True).fit(train)
+                    cache[(group, scaler)] = (pipe.transform(train), pipe.transform(test))
+                elif cols:
+                    pipe = self.make_scaler(scaler).fit(X_train[cols])
+                    cache[(group, scaler)] = (pipe.transform(X_train[cols]), pipe.transform(X_test[cols]))
+                else:
+                    cache[(group, scaler)] = (np.empty((X_train.shape[0], 0)), np.empty((X_test.shape[0], 0)))
+            blocks.append(cache[(group, scaler)])
+        if is_sparse:
+            from scipy import sparse
+            return (sparse.hstack([train for train, _ in blocks], format='csr'),
+                    sparse.hstack([test for _, test in blocks], format='csr'))
+        return np.hstack([train for train, _ in blocks]), np.hstack([test for _, test in blocks])
+
+    def clear_scaled_cache(self):
+        self.scaled_cache={}
+
+    def pipeline_transformer_logreg(self, X_train, y_train, X_test, y_test, scaler_pairs=[('standard','standard')], silent=False, n_jobs=-1):
         """
+        Score a LogisticRegression per (uint32 scaler, float64 scaler) pair.
+
+        The scaled matrices are cached per split and scaler (see scaled_matrices) and
+        the pairs are fit in parallel with joblib on n_jobs cores (-1 for all).
+        SparseFeatures splits (see get_sparse_xy) are fit on CSR matrices with lbfgs, whose
+        cost follows the non-zeros (newton-cholesky builds a dense Hessian).
+        """
+        from sklearn.linear_model import LogisticRegression
+        from joblib import Parallel, delayed
         score_pair={}
        # LogisticRegression instance with settings
         logreg = LogisticRegression(random_state=self.random_state, penalty='l2',
-                                    solver='newton-cholesky',
+                                    solver='lbfgs' if isinstance(X_train, SparseFeatures) else 'newton-cholesky',
                                     class_weight='balanced',
                                     max_iter=3000) 
-        
-        for scaler1,scaler2 in scaler_pairs:
-            ct  = self.feature_scaling_per_type(X_train, scaler1, scaler2)
-            pipeline = Pipeline([
-                            ('column_transformer', ct),
-                            ('logistic_regression', logreg)
-            ])
-            pipeline.fit(X_train, y_train)
-            score_pair[scaler1+","+scaler2]=pipeline.score(X_test, y_test)
+
+        key = self.split_key(X_train, X_test)
+        matrices = [self.scaled_matrices(X_train, X_test, scaler1, scaler2, key=key) for scaler1,scaler2 in scaler_pairs]
+        scores = Parallel(n_jobs=n_jobs)(
+            delayed(fit_score)(logreg, Xs_train, y_train, Xs_test, y_test) for Xs_train, Xs_test in matrices)
+        for (scaler1,scaler2), score in zip(scaler_pairs, scores):
+            score_pair[scaler1+","+scaler2]=score
         
         if not silent:
             for s in score_pair.keys():
@@ -266,14 +448,16 @@ class CustomML:
 
         return score_pair
 
+    def save_model(self, pipeline, path, X_train, binary=False, mapping_hash=None):
+        """
+        Persist a fitted pipeline with its feature columns for score.py
+        (binary for models trained on get_xy_logreg labels)
+        """
+        from .scoring import save_model_bundle
+        save_model_bundle(path, pipeline, X_train, binary=binary, mapping_hash=mapping_hash)
+
     def get_model_scores(self, y_truth, y_pred, silent=False):
-        score_card={}
-        score_card['accuracy_score']=accuracy_score(y_truth, y_pred)
-        score_card['balanced_accuracy_score']=balanced_accuracy_score(y_truth, y_pred)
-        score_card['f1_score']=f1_score(y_truth, y_pred, average='macro')
-        score_card['precision_score']=precision_score(y_truth, y_pred, average='macro')
-        score_card['recall_score']=recall_score(y_truth, y_pred, average='macro')
-        score_card['mean_squared_error']=mean_squared_error(y_truth, y_pred, squared=True) 
+        score_card=model_scores(y_truth, y_pred)
 
         if not silent:
             for s in score_card.keys():
@@ -281,10 +465,117 @@ class CustomML:
         
         return score_card
 
+    def dataset_fingerprint(self):
+        """
+        Content hash of X_data with the split settings, computed once per instance
+        """
+        if getattr(self, '_dataset_fingerprint', None) is None:
+            digest=hashlib.sha256()
+            digest.update(str(list(zip(self.X_data.columns, self.X_data.dtypes.astype(str)))).encode())
+            digest.update(pd.util.hash_pandas_object(self.X_data.astype({'y_label': 'uint32'})).to_numpy().tobytes())
+            digest.update(f"{self.random_state},{self.split_size}".encode())
+            self._dataset_fingerprint=digest.hexdigest()
+        return self._dataset_fingerprint
+
+    def cluster_xy(self, cluster, split, binary=False):
+        """
+        Return X, y of the train or test split of a cluster type, y as uint32 codes
+        (0 = green, 1 = red, 2 = yellow) or, with binary, yellow merged into red
+        """
+        X = self.X_cluster[cluster]['X_'+split]
+        y = self.X_cluster[cluster]['y_'+split].astype('uint32')
+        if binary:
+            y = (y > 0).astype('uint32')
+        return X, y
+
+    def portability_matrix(self, models: dict, scaler_pairs=[None], cluster_types=None,
+                           binary=False, cache_dir=None, n_jobs=-1, silent=False):
+        """
+        Train on the train split of every cluster type and test on the test split of every
+        cluster type, for each model and scaler pair.
+
+        models          {name: estimator}, each is cloned before fitting
+        scaler_pairs    (uint32 scaler, float64 scaler) pairs as in feature_scaling_per_type,
+                        None for the unscaled features
+        cluster_types   defaults to every key of X_cluster
+        binary          merge yellow into red as in get_xy_logreg
+        cache_dir       directory of per combination results, keyed by the dataset
+                        fingerprint and the parameters; cached combinations are not refit
+
+        Combinations are evaluated in parallel with joblib on n_jobs processes (-1 for all).
+        Returns a DataFrame with one row per combination: the get_model_scores metrics,
+        the class labels and the confusion matrix.
+        """
+        from joblib import Parallel, delayed
+        cluster_types = list(cluster_types) if cluster_types else list(self.X_cluster.keys())
+        # pairs given as lists are used as result keys
+        scaler_pairs = [tuple(scalers) if scalers else None for scalers in scaler_pairs]
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        combinations = list(product(models.keys(), scaler_pairs, cluster_types, cluster_types))
+        results = {}
+        pending = []
+        for name, scalers, train, test in combinations:
+            params = {
+                'dataset': self.dataset_fingerprint(),
+                'model': name,
+                'estimator': repr(models[name]),
+                'estimator_params': repr(sorted(models[name].get_params().items())),
+                'scalers': list(scalers) if scalers else None,
+                'train': train,
+                'test': test,
+                'binary': binary,
+            }
+            key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+            path = os.path.join(cache_dir, key + ".json") if cache_dir else None
+            if path and os.path.exists(path):
+                with open(path, "r") as f:
+                    results[(name, scalers, train, test)] = json.load(f)['result']
+            else:
+                pending.append(((name, scalers, train, test), params, path))
+
+        def task(name, scalers, train, test):
+            X_train, y_train = self.cluster_xy(train, 'train', binary)
+            X_test, y_test = self.cluster_xy(test, 'test', binary)
+            if scalers:
+                X_train, X_test = self.scaled_matrices(X_train, X_test, *scalers)
+            return delayed(fit_evaluate)(models[name], X_train, y_train, X_test, y_test)
+
+        if pending:
+            evaluated = Parallel(n_jobs=n_jobs)(task(*combination) for combination, _, _ in pending)
+            for (combination, params, path), result in zip(pending, evaluated):
+                results[combination] = result
+                if path:
+                    with atomic_write(path) as tmp, open(tmp, "w") as f:
+                        json.dump({'params': params, 'result': result}, f)
+
+        # one row per combination in product order, cached or not
+        rows = []
+        for name, scalers, train, test in combinations:
+            result = results[(name, scalers, train, test)]
+            rows.append({
+                'model': name,
+                'scaler_uint32': scalers[0] if scalers else None,
+                'scaler_float64': scalers[1] if scalers else None,
+                'train': train,
+                'test': test,
+                **result['scores'],
+                'labels': result['labels'],
+                'confusion_matrix': result['confusion_matrix'],
+            })
+        matrix = pd.DataFrame(rows)
+        if not silent:
+            print(f"Evaluated {len(pending)} combinations, {len(rows)-len(pending)} from cache")
+            print(matrix.drop(columns=['labels','confusion_matrix']).to_string(index=False))
+        return matrix
+
     def show_confusion_matrix(self, y_truth, y_pred, title="Confusion Matrix for dataset", logreg=False):
         """
         Simple wrapper for ConfusionMatrix function
         """
+        import matplotlib.pyplot as plt
+        from sklearn.metrics import ConfusionMatrixDisplay
         if logreg:
             class_names=['green','red']
         else:
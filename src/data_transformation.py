@@ -1,19 +1,108 @@
 import pandas as pd
+import numpy as np
 from datetime import datetime
-import os, re, time, inspect
+import os, re, time
 from .config import Logger
+from .instrumentation import StageMetrics
+from .collection_filter import CLUSTER_TYPES
+
+# regular expression of substrings in columns dropped from the clean dataset
+DROP_COLUMNS="yy|total_y_|run_id|_vda|_vdb|_sda|_sdb|_sr1|_sr0|_attach|_nvme|_version|_master"
+# columns always kept by filter_columns
+KEEP_ALWAYS=('source', 'y_label')
+# dtypes of the columns added by impute_y_label
+LABEL_DTYPES={'y_label': 'str', 'total_y_label_yellow': 'uint32', 'total_y_label_red': 'uint32',
+              'total_y_label_red_fatal': 'uint32'}
+
+def filter_columns(columns, drop=None, keep=None):
+    """
+    Return the columns kept by a column spec:
+        drop    regex of column names to leave out
+        keep    regex of column names to keep (all when None)
+    source and y_label are always kept
+    """
+    drop_re=re.compile(drop) if drop else None
+    keep_re=re.compile(keep) if keep else None
+    return [colname for colname in columns
+            if colname in KEEP_ALWAYS or (
+                (keep_re is None or keep_re.search(colname)) and not (drop_re and drop_re.search(colname)))]
 
 class DataTransformation:
     """
     Utility functions for data transofmration
     """
-    def __init__(self, y_label_yellow=[], y_label_red=[], y_label_red_fatal=[], logger=None):
+    def __init__(self, y_label_yellow=[], y_label_red=[], y_label_red_fatal=[], logger=None, metrics=None):
         self.logger = logger if logger else Logger(show_message=False).logger
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Initializing DataTransformation class.")
+        self.metrics = metrics if metrics else StageMetrics()
+        self.logger.debug("Initializing DataTransformation class.")
         self.y_label_yellow = y_label_yellow
         self.y_label_red = y_label_red
         self.y_label_red_fatal = y_label_red_fatal
-        self.logger.debug(f"[{inspect.stack()[0][3]}] DataTransformation initialization completed.")
+        # compiled yy-column membership per column layout
+        self.label_plans = {}
+        self.logger.debug("DataTransformation initialization completed.")
+
+    def compile_label_plan(self, columns):
+        """
+        Compile, once per column layout, the positions of the yellow, red and red_fatal
+        columns and a membership matrix so the three totals come from one matrix product
+        """
+        key = tuple(columns)
+        if key in self.label_plans:
+            return self.label_plans[key]
+
+        logical_or="|"
+        patterns = [re.compile(logical_or.join(labels))
+                    for labels in (self.y_label_yellow, self.y_label_red, self.y_label_red_fatal)]
+        yy = re.compile("yy")
+        index = [pos for pos, colname in enumerate(key) if any(p.search(str(colname)) for p in patterns)]
+        membership = np.zeros((len(index), len(patterns)), dtype=np.float64)
+        for row, pos in enumerate(index):
+            for col, p in enumerate(patterns):
+                if p.search(str(key[pos])):
+                    membership[row, col] = 1
+
+        plan = {
+            'index': np.array(index, dtype=np.intp),
+            'membership': membership,
+            'total_yy_labels': sum(1 for colname in key if yy.search(str(colname))), # total number of yy features
+        }
+        self.label_plans[key] = plan
+        return plan
+
+    def y_label_totals(self, df):
+        """
+        Return (totals, total_yy_labels) where totals is a (rows, 3) uint32 array with the
+        number of yellow, red and red_fatal labels per row
+        """
+        plan = self.compile_label_plan(df.columns)
+        values = df.iloc[:, plan['index']].to_numpy(dtype=np.float64)
+        totals = (values @ plan['membership']).astype('uint32')
+        return totals, plan['total_yy_labels']
+
+    def validate_label_weight(self, label_weight):
+        for w in label_weight:
+            if not 0 <= w <= 1:
+                self.logger.error("y_label weight must be (0 <= w <= 1). Usign default label_weight=[0.25,0.10,0.00]")
+                return [0.25,0.10,0.010]
+        return label_weight
+
+    def select_y_label(self, totals, total_yy_labels, qty_control_plane, label_weight):
+        """
+        Vectorized y_label selection from the label totals
+        """
+        yellow, red, red_fatal = totals[:, 0], totals[:, 1], totals[:, 2]
+        is_red = (
+            (red > round(total_yy_labels * label_weight[1]))            # has red above thresshold
+            | (red_fatal > round(total_yy_labels * label_weight[2]))    # has any red_fatal
+            | (qty_control_plane < 2)                                   # less than 2 active control planes
+        )
+        is_yellow = (
+            ((yellow.astype(np.int64) + red.astype(np.int64) * 2)       # Each red counts double
+             > round(total_yy_labels * label_weight[0]))
+            | (qty_control_plane == 2)                                  # 2 active control planes
+        )
+        return np.select([is_red, is_yellow], ['red', 'yellow'], default='green')
 
     def impute_y_label(self, df, label_weight=[0.25,0.10,0.00]):
         """
@@ -23,64 +112,69 @@ class DataTransformation:
                     is the percentage (0.0 <= w <= 1.0) for the treshold for applying the y_label color.
                     When the weight is 0% it meaans that anything > 0 will trigger the color
         """
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Starting to impute y_label.")
+        self.logger.debug("Starting to impute y_label.")
 
+        label_weight = self.validate_label_weight(label_weight)
+        with self.metrics.stage("impute_y_label") as stage:
+            totals, total_yy_labels = self.y_label_totals(df)
 
-        for w in label_weight:
-            if not 0 <= w <= 1:
-                self.logger.error(f"[{inspect.stack()[0][3]}] y_label weight must be (0 <= w <= 1). Usign default label_weight=[0.25,0.10,0.00]")
-                label_weight=[0.25,0.10,0.010]
-                break
-
-        total_yy_labels = df.filter(regex="yy").shape[1] # total number of yy features
-        df['y_label']='green' # by default assume everything is green
+            df['y_label'] = self.select_y_label(totals, total_yy_labels,
+                                                df['total_qty_control_plane'].to_numpy(), label_weight)
+            df['total_y_label_yellow'] = totals[:, 0]
+            df['total_y_label_red'] = totals[:, 1]
+            df['total_y_label_red_fatal'] = totals[:, 2]
+            stage.observe(df)
 
-        # initialize columns calculating the number of labels per type (yellow, red, red_fatal)
-        self.logger.warn(f"[{inspect.stack()[0][3]}] Known issue. Requires optimization for performance.")
-        logical_or="|"
-        df['total_y_label_yellow']=df.filter(regex=logical_or.join(self.y_label_yellow)).sum(axis=1).astype('uint32')
-        df['total_y_label_red']=df.filter(regex=logical_or.join(self.y_label_red)).sum(axis=1).astype('uint32')
-        df['total_y_label_red_fatal']=df.filter(regex=logical_or.join(self.y_label_red_fatal)).sum(axis=1).astype('uint32')
-
-        # formula for yellow state
-        df.loc[
-            (
-                ( df['total_y_label_yellow'] 
-                 + (df['total_y_label_red'] * 2)           # Each red counts double
-                 ) > round(total_yy_labels * label_weight[0])
-            ), 
-            ['y_label']]='yellow'
-        
-        # if has red above thresshold assign color red
-        df.loc[(df['total_y_label_red'] > round(total_yy_labels * label_weight[1])), ['y_label']]='red'
-
-        # if has any red_fatal then y_label=red
-        df.loc[(df['total_y_label_red_fatal'] > round(total_yy_labels * label_weight[2])), ['y_label']]='red'
-
-        # Additional overrides for y_labels based on qty of active control planes
-        df.loc[
-            (df['y_label'] != 'red') & 
-            (df['total_qty_control_plane'] < 2),
-            'y_label'] = "red"
-
-        df.loc[
-            (df['y_label'] != 'red') & 
-            (df['total_qty_control_plane'] == 2),
-            'y_label'] = "yellow"
-        
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Ending imputing y_label from {total_yy_labels} columns.")
+        self.logger.debug(f"Ending imputing y_label from {total_yy_labels} columns.")
         return df
 
+    def label_columns(self):
+        """
+        Regex of the columns impute_y_label reads
+        """
+        return "|".join(["yy", "total_qty_control_plane"] +
+                        [labels for labels in ("|".join(self.y_label_yellow), "|".join(self.y_label_red),
+                                               "|".join(self.y_label_red_fatal)) if labels])
+
+    def impute_y_label_and_drop(self, df, label_weight=[0.25,0.10,0.00], drop=DROP_COLUMNS, keep=None):
+        """
+        impute_y_label, then drop the columns outside the drop/keep spec (see filter_columns),
+        so columns read only to derive the labels are discarded right away
+        """
+        df=self.impute_y_label(df, label_weight)
+        columns=filter_columns(df.columns, drop, keep)
+        if len(columns) == df.shape[1]:
+            return df
+        return df[columns]
+
+    def impute_y_label_grid(self, df, label_weights):
+        """
+        Return a DataFrame with one y_label column per label_weight in label_weights,
+        computing the label totals only once
+        """
+        self.logger.debug(f"Starting to impute {len(label_weights)} y_label settings.")
+
+        totals, total_yy_labels = self.y_label_totals(df)
+        qty_control_plane = df['total_qty_control_plane'].to_numpy()
+        labels = {
+            ",".join(str(w) for w in label_weight):
+                self.select_y_label(totals, total_yy_labels, qty_control_plane, self.validate_label_weight(label_weight))
+            for label_weight in label_weights
+        }
+
+        self.logger.debug("Ending imputing y_label settings.")
+        return pd.DataFrame(labels, index=df.index)
+
     def y_by_group(self, df):
         """
         Print aggregations of y_label
         """
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Starting displaying y_label aggregation.")
+        self.logger.debug("Starting displaying y_label aggregation.")
 
         print(f"----\nBy y_label:\n {df.groupby(['y_label'])['y_label'].count()}\n")
         print(f"----\nBy source by y_label:\n {df.groupby(['source','y_label'])['source'].count()}")
 
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Ending displaying y_label aggregation.")
+        self.logger.debug("Ending displaying y_label aggregation.")
 
     def normalize_sources(self, df):
         """
@@ -88,28 +182,70 @@ class DataTransformation:
             compact     3 nodes clusters
             mno         6 nodes clusters
         """
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Starting aggregating sources.")
+        self.logger.debug("Starting aggregating sources.")
 
-        df.loc[df['source'].str.contains('compact|promql',case=False), ['source']]='compact'
-        df.loc[df['source'].str.contains('mno',case=False), ['source']]='mno'
+        if isinstance(df['source'].dtype, pd.CategoricalDtype):
+            # compact datasets: rename the categories instead of every row
+            sources=df['source'].cat.categories.to_series()
+            for cluster_type, pattern in CLUSTER_TYPES.items():
+                sources[sources.str.contains(pattern,case=False)]=cluster_type
+            df['source']=df['source'].map(sources).astype('category')
+        else:
+            for cluster_type, pattern in CLUSTER_TYPES.items():
+                df.loc[df['source'].str.contains(pattern,case=False), ['source']]=cluster_type
 
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Ending aggregating sources.")
+        self.logger.debug("Ending aggregating sources.")
+
+    def compact_dataset(self, df, categorical_columns=['source','y_label']):
+        """
+        Reduce the memory footprint of df:
+            categorical_columns are stored as categoricals
+            unsigned integer columns are downcast to the smallest type holding their maximum
+            float64 columns are downcast to float32 when no value loses precision
+        Returns the compacted DataFrame and logs the memory usage before and after.
+        """
+        self.logger.debug("Starting compacting dataset.")
+        memory_before=df.memory_usage(deep=True).sum()
+
+        dtypes={}
+        for colname in df.columns:
+            col=df[colname]
+            if colname in categorical_columns:
+                dtypes[colname]='category'
+            elif pd.api.types.is_unsigned_integer_dtype(col):
+                dtypes[colname]=np.min_scalar_type(col.max() if len(col) else 0)
+            elif col.dtype == 'float64':
+                values=col.to_numpy()
+                if np.array_equal(values.astype(np.float32).astype(np.float64), values, equal_nan=True):
+                    dtypes[colname]='float32'
+        dtypes={colname: dtype for colname, dtype in dtypes.items() if df[colname].dtype != dtype}
+        if dtypes:
+            df=df.astype(dtypes)
+
+        memory_after=df.memory_usage(deep=True).sum()
+        self.logger.info(f"Memory usage {memory_before/2**20:.1f} MiB -> {memory_after/2**20:.1f} MiB "
+                         f"({len(dtypes)} columns compacted).")
+        return df
 
-    def get_clean_dataset(self, df):
+    def get_clean_dataset(self, df, deduplicator=None):
         """
         Consolidate clusters into two groups: compact and mno
             compact     3 nodes clusters
             mno         6 nodes clusters
         """
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Starting cleaning dataset. Initial shape {df.shape}")
+        self.logger.debug(f"Starting cleaning dataset. Initial shape {df.shape}")
 
-        # regular expression of substrings in columns to drop
-        regex=f"yy|total_y_|run_id|_vda|_vdb|_sda|_sdb|_sr1|_sr0|_attach|_nvme|_version|_master"
-        df=df[df.columns.drop(list(df.filter(regex=regex, axis=1)))]
+        with self.metrics.stage("get_clean_dataset") as stage:
+            df=df[df.columns.drop(list(df.filter(regex=DROP_COLUMNS, axis=1)))]
 
-        # drop duplicate rows
-        df=df.drop_duplicates()
+            # drop duplicate rows
+            if deduplicator is None:
+                df=df.drop_duplicates()
+            else:
+                # hash-based, also drops rows seen in earlier batches or runs
+                df=deduplicator.filter(df)
+            stage.observe(df)
 
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Ending cleaning dataset. Final shape {df.shape}")
+        self.logger.debug(f"Ending cleaning dataset. Final shape {df.shape}")
         return df
 
@@ -1,19 +1,107 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import pyarrow.compute as pc
 from datetime import datetime
-import os, sys, re, time, inspect
-from itertools import permutations, combinations
+import os, sys, re, time, hashlib, logging
+from itertools import permutations, combinations, repeat
+from concurrent.futures import ProcessPoolExecutor
+from .schema_plan import SchemaPlanCache
+from .manifest import Manifest
+from .data_transformation import DataTransformation, filter_columns, LABEL_DTYPES
+from .deduplication import RowDeduplicator
+from .instrumentation import StageMetrics
+from .wrangle_cache import WrangleCache
+from .config import compile_mapping
+from .collection_filter import CollectionFilter, TIMESTAMP_FORMAT
+from .long_layout import LongLayout
+
+NODE_PREFIX = re.compile(r"^node._")
+# derived hive partition column when partitioning the output by run_id date
+DATE_PARTITION = "run_date"
+
+# per-process DataWrangle instance used by the parallel ingestion workers
+_worker_wrangler = None
+
+def _init_worker(mapping_set, y_map_set, logger, dstdir, plan_cache_dir, metrics_enabled, wrangle_cache_dir, compiled):
+    global _worker_wrangler
+    _worker_wrangler = DataWrangle(mapping_set, y_map_set, logger, dstdir=dstdir, plan_cache_dir=plan_cache_dir,
+                                   metrics=StageMetrics(enabled=metrics_enabled), wrangle_cache_dir=wrangle_cache_dir,
+                                   compiled=compiled)
+    if _worker_wrangler.wrangle_cache is not None:
+        # the parent process owns the cache index
+        _worker_wrangler.wrangle_cache.save_index = False
+
+def _wrangle_in_worker(fname, projection):
+    df = _worker_wrangler.wrangle_file(fname, **projection)
+    return df, _worker_wrangler.metrics.pop_records()
+
+def _validate_in_worker(fname):
+    return _worker_wrangler.validate_schema(fname)
+
+def open_wrangled_dataset(path: str):
+    """
+    Open a wrangled Parquet file or hive-partitioned directory as a pyarrow dataset whose
+    schema is the union of all the fragment schemas (ds.dataset only reads the first one),
+    so columns missing from some partitions are read as nulls instead of being dropped
+    """
+    dataset=ds.dataset(path, format="parquet", partitioning="hive")
+    schema=pa.unify_schemas([fragment.physical_schema for fragment in dataset.get_fragments()]
+                            + [dataset.partitioning.schema])
+    return ds.dataset(path, schema=schema, format="parquet", partitioning="hive")
+
+def arrow_kind(arrow_type):
+    """
+    Coarse kind (numeric, datetime, string) of an Arrow type, None for all-null columns
+    """
+    if pa.types.is_null(arrow_type):
+        return None
+    if pa.types.is_dictionary(arrow_type):
+        return arrow_kind(arrow_type.value_type)
+    if pa.types.is_boolean(arrow_type) or pa.types.is_integer(arrow_type) \
+            or pa.types.is_floating(arrow_type) or pa.types.is_decimal(arrow_type):
+        return 'numeric'
+    if pa.types.is_timestamp(arrow_type) or pa.types.is_date(arrow_type):
+        return 'datetime'
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return 'string'
+    return str(arrow_type)
+
+def dtype_accepts(mapped_dtype: str, kind):
+    """
+    True when set_dtypes can cast a column of the given Arrow kind to mapped_dtype
+    """
+    dtype=pd.api.types.pandas_dtype(mapped_dtype)
+    if kind is None or pd.api.types.is_string_dtype(dtype) or pd.api.types.is_object_dtype(dtype):
+        return True
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        # raw run_id values are TIMESTAMP_FORMAT strings
+        return kind in ('datetime', 'string')
+    return kind == 'numeric'
 
 class DataWrangle:
-    def __init__(self, mapping_set, y_map_set, logger, dstdir="data/wrangle"):
+    def __init__(self, mapping_set, y_map_set, logger, dstdir="data/wrangle", plan_cache_dir=None, metrics=None,
+                 wrangle_cache_dir=None, compiled=None):
         self.logger = logger
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Starting DataWrangle initialization.")
+        # stage timings, disabled (no-op) unless a StageMetrics(enabled=True) is given
+        self.metrics = metrics if metrics else StageMetrics()
+        self.logger.debug("Starting DataWrangle initialization.")
         self.dstdir = dstdir
         if not os.path.exists(self.dstdir):
             os.makedirs(self.dstdir)
         # x_feature dtype definition
         self.mapping_set = mapping_set
         self.dtypes_maps = {}
+        self.cast_plans = {}
+        self.arrow_schemas = {}
+        # lookup tables compiled from the mapping and y-map (Config.compiled, compiled here when None)
+        self.compiled = compiled if compiled else compile_mapping(mapping_set, y_map_set)
         self.init_dtypes()
+        # column transformation plans per raw schema (in memory and optionally on disk)
+        self.mapping_hash = self.compiled['mapping_hash']
+        self.plan_cache_dir = plan_cache_dir
+        self.plan_cache = SchemaPlanCache(plan_cache_dir)
         #
         self.y_map_set = y_map_set
         self.y_label_maps = {}
@@ -21,38 +109,35 @@ class DataWrangle:
         self.y_label_red = []
         self.y_label_red_fatal = []
         self.init_y_label_maps()
+        # wrangled per-file outputs (Arrow IPC) keyed by source, mapping and labels hashes
+        self.wrangle_cache_dir = wrangle_cache_dir
+        self.wrangle_cache = None
+        if wrangle_cache_dir:
+            self.wrangle_cache = WrangleCache(wrangle_cache_dir, self.mapping_hash, self.compiled['labels_hash'])
         #
         self.df = pd.DataFrame()
         self.combined_df = pd.DataFrame()
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Completed DataWrangle initialization.")
+        self.table = None
+        self.logger.debug("Completed DataWrangle initialization.")
 
     def init_y_label_maps(self):
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Initializing y-label mapping.")
-        for entry in self.y_map_set:
-            name=entry['name']
-            label=entry['label']
-            self.y_label_maps[name]=label    
-            if label == 'yellow':
-                self.y_label_yellow.append(name)
-            elif label == 'red':
-                self.y_label_red.append(name)
-            elif label == 'red_fatal':
-                self.y_label_red_fatal.append(name)
-            else:
-                continue
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Completed loading {len(self.y_label_maps.keys())} y-label features.")        
+        self.logger.debug("Initializing y-label mapping.")
+        y_labels=self.compiled['y_labels']
+        self.y_label_maps=dict(y_labels['y_label_maps'])
+        self.y_label_yellow=list(y_labels['yellow'])
+        self.y_label_red=list(y_labels['red'])
+        self.y_label_red_fatal=list(y_labels['red_fatal'])
+        self.logger.debug(f"Completed loading {len(self.y_label_maps.keys())} y-label features.")        
 
     def init_dtypes(self):
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Initializing dtypes mapping.")
-        for entry in self.mapping_set:
-            for item in entry['names']:
-                self.dtypes_maps[item]=entry['dtype']       
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Completed dtypes for {len(self.dtypes_maps.keys())} features.")
+        self.logger.debug("Initializing dtypes mapping.")
+        self.dtypes_maps=dict(self.compiled['dtypes_maps'])
+        self.logger.debug(f"Completed dtypes for {len(self.dtypes_maps.keys())} features.")
 
     def node_from_colname(self, colname: str):
-        x=re.findall(r"^node._",colname)
-        if len(x) > 0:
-            return x[0][:-1]
+        x=NODE_PREFIX.match(colname)
+        if x:
+            return x.group(0)[:-1]
         else:
             return ''
     
@@ -67,78 +152,94 @@ class DataWrangle:
         """
         Convert all the column values to proper timestamp
         """
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Starting timestamp convertion of {self.df.shape[0]} rows.")
-        self.df[colname]=self.df[colname].apply(lambda x: datetime.fromtimestamp(time.mktime(time.strptime(x, "%Y%m%d-%H%M%S"))))
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Completed timestamp convertion of {self.df.shape[0]} rows.")
+        self.logger.debug(f"Starting timestamp convertion of {self.df.shape[0]} rows.")
+        if not pd.api.types.is_datetime64_any_dtype(self.df[colname]):
+            self.df[colname]=pd.to_datetime(self.df[colname], format=TIMESTAMP_FORMAT)
+        self.logger.debug(f"Completed timestamp convertion of {self.df.shape[0]} rows.")
 
-    def set_dtypes(self, fatal_if_not_mapped=False):
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Starting dtype conversion.")
-        self.logger.debug(f"Working dtypes for DataFrame with shape {self.df.shape}")
-        cols = self.df.columns
-        for colname in cols:
+    def build_cast_plan(self, columns, fatal_if_not_mapped=False):
+        """
+        Return the cast plan {colname: dtype} for the given columns.
+        Plans are built once per column layout and reused on later calls.
+        """
+        key = tuple(columns)
+        if key in self.cast_plans:
+            return self.cast_plans[key]
+
+        self.logger.debug(f"Building cast plan for {len(key)} columns.")
+        plan = {}
+        for colname in key:
             mapped_colname = self.map_colname(colname)
-            try:
-                mapped_dtype = self.dtypes_maps[mapped_colname]
-            except:
+            # labels imputed while loading (see load_dataset label_weight) are not in the mapping
+            mapped_dtype = self.dtypes_maps.get(mapped_colname, LABEL_DTYPES.get(colname))
+            if mapped_dtype is None:
                 # if unknown dtype assume string
-                self.logger.warn(f"[{inspect.stack()[0][3]}] Missing dtype map for {mapped_colname}({colname}). Using `string`.")
+                self.logger.warn(f"Missing dtype map for {mapped_colname}({colname}). Using `string`.")
                 if fatal_if_not_mapped:
-                    import sys
                     print(f"Forcing exit due to missing dtype mapping")
                     sys.exit()
                 mapped_dtype = 'string'
-            if mapped_dtype == "datetime64":
+            plan[colname] = mapped_dtype
+        self.cast_plans[key] = plan
+        return plan
+
+    def set_dtypes(self, fatal_if_not_mapped=False):
+        self.logger.debug("Starting dtype conversion.")
+        self.logger.debug(f"Working dtypes for DataFrame with shape {self.df.shape}")
+        plan = self.build_cast_plan(self.df.columns, fatal_if_not_mapped)
+        for colname, mapped_dtype in plan.items():
+            if mapped_dtype.startswith("datetime64"):
                 self.convert_to_timestamp(colname)
-            self.df[colname]=self.df[colname].astype(mapped_dtype)
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Dtype conversion completed.")
+        # single bulk cast of the columns not already in their target dtype
+        dtypes = self.df.dtypes
+        casts = {colname: mapped_dtype for colname, mapped_dtype in plan.items()
+                 if str(dtypes[colname]) != str(pd.api.types.pandas_dtype(mapped_dtype))}
+        if casts:
+            self.df = self.df.astype(casts)
+        self.logger.debug("Dtype conversion completed.")
 
 
-    def swap_nodes(self,nodeA, nodeB):
+    def node_swap_map(self, columns, nodeA, nodeB):
         """
-        switch node identifier in columns
+        Return the rename map switching the node identifier nodeA and nodeB in columns
         """
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Starting node swap for {nodeA} and {nodeB}")
-
         cols_to_rename = {}
 
-        nodeA_cols=self.df.filter(regex=nodeA).columns
-        nodeA_cols_fixed=nodeA_cols.str.replace(nodeA,nodeB)
-        nodeA_map = {nodeA_cols[i]: nodeA_cols_fixed[i] for i in range(len(nodeA_cols))}
+        nodeA_cols=[colname for colname in columns if re.search(nodeA, colname)]
+        cols_to_rename.update({colname: colname.replace(nodeA,nodeB) for colname in nodeA_cols})
 
-        nodeB_cols=self.df.filter(regex=nodeB).columns
-        nodeB_cols_fixed=nodeB_cols.str.replace(nodeB,nodeA)
-        nodeB_map = {nodeB_cols[i]: nodeB_cols_fixed[i] for i in range(len(nodeB_cols))}
+        nodeB_cols=[colname for colname in columns if re.search(nodeB, colname)]
+        cols_to_rename.update({colname: colname.replace(nodeB,nodeA) for colname in nodeB_cols})
 
-        cols_to_rename.update(nodeA_map)
-        cols_to_rename.update(nodeB_map)
+        return cols_to_rename
 
-        self.df=self.df.rename(columns=cols_to_rename)
+    def swap_nodes(self,nodeA, nodeB):
+        """
+        switch node identifier in columns
+        """
+        self.logger.debug(f"Starting node swap for {nodeA} and {nodeB}")
 
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Completed node swap for {nodeA} and {nodeB}")
+        self.df=self.df.rename(columns=self.node_swap_map(self.df.columns, nodeA, nodeB))
 
+        self.logger.debug(f"Completed node swap for {nodeA} and {nodeB}")
 
-    def fix_node_ordering(self):
+    def node_ordering_swaps(self, columns):
         """
-        Validate abstracted node name maps to roles:
-            nodes 1-3: master, control_plane, worker (optional)
-            nodes 4-6: worker
+        Return the list of (nodeA, nodeB) swaps required so that nodes 1-3 are the control-plane nodes.
+        Raises ValueError when the columns do not describe 3 control-plane nodes.
         """
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Starting node ordering verification.")
-
-        # for item in self.df.columns:
-        #     print(item)
-
         role_control_plane=['node1', 'node2', 'node3']
         role_other=['node4','node5','node6']
         cp_role_fix=[]
         other_role_fix=[]
 
-        cp_nodes=self.df.filter(regex="node._control_plane").columns.str.replace('_control_plane','')
+        cp_nodes=[colname.replace('_control_plane','') for colname in columns if re.search("node._control_plane", colname)]
 
         for cp in role_control_plane:
             if cp not in cp_nodes:
                 cp_role_fix.append(cp)
 
+        swaps=[]
         if len(cp_role_fix) > 0:
             # we need to find correct node and rename columns
             for other in role_other:
@@ -146,44 +247,165 @@ class DataWrangle:
                     other_role_fix.append(other)
 
             if len(cp_role_fix) != len(other_role_fix):
-                self.logger.error(f"[{inspect.stack()[0][3]}] Fatal Error. Requires 3 control-plane nodes.")
-                sys.exit(1)
+                raise ValueError("Requires 3 control-plane nodes.")
 
-            print (f"Need to switch {cp_role_fix} and {other_role_fix}")
             for idx in range(len(cp_role_fix)):
-                nodeA=cp_role_fix.pop()
-                nodeB=other_role_fix.pop()
-                self.swap_nodes(nodeA, nodeB)            
+                swaps.append((cp_role_fix.pop(), other_role_fix.pop()))
+        return swaps
 
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Completed node ordering verification.")
-
-    def randomize_nodes(self):
+    def fix_node_ordering(self):
         """
-        Node name maps to roles:
+        Validate abstracted node name maps to roles:
             nodes 1-3: master, control_plane, worker (optional)
             nodes 4-6: worker
         """
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Starting node combination.")
+        self.logger.debug("Starting node ordering verification.")
+
+        try:
+            swaps=self.node_ordering_swaps(self.df.columns)
+        except ValueError as e:
+            self.logger.error(f"Fatal Error. {e}")
+            sys.exit(1)
 
-        # for item in self.df.columns:
-        #     print(item)
+        self.print_node_swaps(swaps)
+        for nodeA, nodeB in swaps:
+            self.swap_nodes(nodeA, nodeB)
 
+        self.logger.debug("Completed node ordering verification.")
+
+    def print_node_swaps(self, swaps):
+        if swaps:
+            print (f"Need to switch {[nodeA for nodeA, _ in reversed(swaps)]} and {[nodeB for _, nodeB in reversed(swaps)]}")
+
+    def node_permutations(self, columns):
+        """
+        Return the column names of every node-symmetry permutation of columns, in the order
+        randomize_nodes produces them: the original layout first, then one layout per
+        control-plane swap and worker swap combination.
+        """
         role_control_plane=['node1', 'node2', 'node3']
         role_other=['node4','node5','node6']
 
-        df_combined = self.df.copy()
+        names=list(columns)
+        layouts=[names]
         for c1,c2 in combinations(role_control_plane, 2):
-            self.swap_nodes(c1, c2)
-            self.logger.debug(f"[swap_nodes:control-plane] {c1} {c2}")
+            swap=self.node_swap_map(names, c1, c2)
+            names=[swap.get(colname, colname) for colname in names]
             for w1,w2 in combinations(role_other, 2):
-                self.swap_nodes(w1, w2)
-                df_combined=pd.concat([df_combined,self.df], ignore_index=True)
-                self.logger.debug(f"[swap_nodes:workers] {w1} {w2}")
+                swap=self.node_swap_map(names, w1, w2)
+                names=[swap.get(colname, colname) for colname in names]
+                layouts.append(names)
+        return layouts
+
+    def node_permutation_indexers(self, columns):
+        """
+        Precompute the column-index permutations of node_permutations.
 
-        df_combined.reset_index(drop=True, inplace=True)
-        self.df = df_combined.copy()
+        Returns (output_columns, indexers) where indexers[k][i] is the position in columns
+        holding output_columns[i] for permutation k, or -1 when that permutation lacks it.
+        """
+        layouts=self.node_permutations(columns)
+        output_columns=pd.Index(list(dict.fromkeys(colname for names in layouts for colname in names)))
+        indexers=[pd.Index(names).get_indexer(output_columns) for names in layouts]
+        return output_columns, indexers
+
+    def iter_node_permutations(self, df=None, batch_size=None):
+        """
+        Yield node-symmetry augmented DataFrames one permutation (and optionally one batch of
+        batch_size rows) at a time, so only one permuted copy is held in memory.
+        Columns a permutation lacks are filled with 0 in the dtype of the column it mirrors.
+        """
+        df=self.df if df is None else df
+        output_columns, indexers=self.node_permutation_indexers(df.columns)
+        dtypes={}
+        for indexer in indexers:
+            for colname, pos in zip(output_columns, indexer):
+                if pos >= 0:
+                    dtypes.setdefault(colname, df.dtypes.iloc[pos])
+        batch_size=batch_size or max(df.shape[0], 1)
 
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Completed node combination.")
+        for indexer in indexers:
+            present=indexer >= 0
+            for start in range(0, df.shape[0], batch_size):
+                frame=df.iloc[start:start+batch_size, indexer[present]].set_axis(output_columns[present], axis=1)
+                if not present.all():
+                    frame=frame.reindex(columns=output_columns, fill_value=0).astype(
+                        {colname: dtypes[colname] for colname in output_columns[~present]})
+                yield frame
+
+    def write_node_permutations(self, file_name: str, batch_size=None, compression="snappy", compression_level=None):
+        """
+        Write the node-symmetry augmented dataset to dstdir/file_name without holding
+        every permutation in memory
+        """
+        self.logger.debug(f"Writing node permutations to {file_name}.")
+        fname=self.dstdir+"/"+file_name
+        writer=None
+        try:
+            for frame in self.iter_node_permutations(batch_size=batch_size):
+                table=pa.Table.from_pandas(frame, preserve_index=False)
+                if writer is None:
+                    writer=pq.ParquetWriter(fname, table.schema,
+                                            **self.parquet_write_options(frame, compression, compression_level))
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        self.logger.debug(f"Saved node permutations to {fname}")
+
+    def randomize_nodes(self):
+        """
+        Node name maps to roles:
+            nodes 1-3: master, control_plane, worker (optional)
+            nodes 4-6: worker
+
+        Concatenates every node permutation of self.df. Use iter_node_permutations or
+        write_node_permutations to augment without holding all permutations in memory.
+        """
+        self.logger.debug("Starting node combination.")
+
+        with self.metrics.stage("randomize_nodes") as stage:
+            layouts=self.node_permutations(self.df.columns)
+            self.df=pd.concat([self.df.set_axis(names, axis=1) for names in layouts], ignore_index=True)
+            stage.observe(self.df)
+
+        self.logger.debug(f"Completed node combination of {len(layouts)} permutations.")
+
+    def etcd_rename_map(self, columns):
+        """
+        Return the rename map from cluster specific etcd feature names to canonical names.
+        Raises ValueError when the columns do not describe 3 etcd nodes.
+        """
+        alias_map={}
+
+        etcd_object_counts_cols=[colname for colname in columns if re.search('etcd_object_counts', colname)]
+        node_etcd_ip=[colname.replace('etcd_object_counts','') for colname in etcd_object_counts_cols]
+
+        etcd_failed_proposal_cols=[colname for colname in columns if re.search('etcd_failed_proposal', colname)]
+        node_etcd_name=[re.sub('node._', '', colname.replace('etcd_failed_proposal','')) for colname in etcd_failed_proposal_cols]
+
+        etcd_network_peer_rtt_cols=[colname for colname in columns if re.search('etcd_network_peer_rtt', colname)]
+        etcd_fsync_duration_cols=[colname for colname in columns if re.search('etcd_fsync_duration', colname)]
+
+        if len(node_etcd_ip) != 3 or len(node_etcd_name) != 3:
+            raise ValueError("Requires 3 etcd nodes.")
+
+        cp_nodes_list=['node1', 'node2', 'node3']
+        for idx in range(3):
+            # assume order in the list is correct
+            alias_map[node_etcd_name[idx]]=cp_nodes_list[idx]
+            alias_map[node_etcd_ip[idx]]=cp_nodes_list[idx]
+
+        rename_map={}
+        for cols, suffix in ((etcd_object_counts_cols, "_etcd_object_counts"),
+                             (etcd_failed_proposal_cols, "_etcd_failed_proposal"),
+                             (etcd_network_peer_rtt_cols, "_etcd_network_peer_rtt"),
+                             (etcd_fsync_duration_cols, "_etcd_fsync_duration")):
+            for item in cols:
+                for key in alias_map.keys():
+                    if key in item:
+                        rename_map[item]=alias_map[key]+suffix
+        return rename_map
 
     def feature_name_normalization(self):
         """
@@ -205,104 +427,691 @@ class DataWrangle:
             node1_etcd_failed_proposal
             node1_etcd_fsync_duration
         """
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Starting feature name normalization.")
+        self.logger.debug("Starting feature name normalization.")
 
-        alias_map={}
+        try:
+            rename_map=self.etcd_rename_map(self.df.columns)
+        except ValueError as e:
+            self.logger.error(f"Fatal Error. {e}")
+            sys.exit(1)
 
-        etcd_object_counts_cols=self.df.filter(regex='etcd_object_counts').columns
-        node_etcd_ip=etcd_object_counts_cols.str.replace('etcd_object_counts','')
+        self.df.rename(columns = rename_map, inplace = True)
+        self.logger.debug("Completing feature name normalization.")
 
-        etcd_failed_proposal_cols=self.df.filter(regex='etcd_failed_proposal').columns
-        node_etcd_name=etcd_failed_proposal_cols.str.replace('etcd_failed_proposal','')
-        node_etcd_name=node_etcd_name.str.replace('node._','')
+    def resolve_columns(self, columns, verbose=True):
+        """
+        Apply the node reordering and etcd renaming rules to a raw column layout.
+        Returns (swap_map, rename_map, columns).
+        Raises ValueError when the layout fails the control-plane or etcd checks.
+        """
+        raw_cols=list(columns)
+        names=list(raw_cols)
+        swaps=self.node_ordering_swaps(names)
+        if verbose:
+            self.print_node_swaps(swaps)
+        for nodeA, nodeB in swaps:
+            swap=self.node_swap_map(names, nodeA, nodeB)
+            names=[swap.get(colname, colname) for colname in names]
+        swap_map={raw: name for raw, name in zip(raw_cols, names) if raw != name}
 
-        etcd_network_peer_rtt_cols=self.df.filter(regex='etcd_network_peer_rtt').columns
-        etcd_fsync_duration_cols=self.df.filter(regex='etcd_fsync_duration').columns
+        rename_map=self.etcd_rename_map(names)
+        names=[rename_map.get(colname, colname) for colname in names]
+        return swap_map, rename_map, names
 
-        if len(node_etcd_ip) != 3 or len(node_etcd_name) != 3:
-                self.logger.error(f"[{inspect.stack()[0][3]}] Fatal Error. Requires 3 etcd nodes.")
-                sys.exit(1)
+    def build_schema_plan(self, columns, verbose=True):
+        """
+        Build the full column transformation for a raw column layout:
+            swap_map    node reordering (fix_node_ordering)
+            rename_map  etcd canonical names (feature_name_normalization)
+            dtypes      cast plan of the resulting columns (set_dtypes)
+        Raises ValueError when the layout fails the control-plane or etcd checks.
+        """
+        swap_map, rename_map, names=self.resolve_columns(columns, verbose)
+        return {
+            'swap_map': swap_map,
+            'rename_map': rename_map,
+            'columns': names,
+            'dtypes': self.build_cast_plan(names),
+        }
+
+    def cached_schema_plan(self, columns, verbose=True):
+        """
+        Return the cached schema plan for columns, building and caching it when missing
+        (verbose prints the node swaps applied).
+        Raises ValueError when the layout fails the control-plane or etcd checks.
+        """
+        key=self.plan_cache.fingerprint(columns, self.mapping_hash)
+        plan=self.plan_cache.get(key)
+        if plan is None:
+            self.logger.debug(f"Building schema plan {key[:12]}.")
+            plan=self.build_schema_plan(columns, verbose)
+            self.plan_cache.put(key, plan)
         else:
-            cp_nodes_list=['node1', 'node2', 'node3']
-            for idx in range(3):
-                node_ip = node_etcd_ip[idx]
-                # try:
-                #     node_name=list(filter(lambda x: node_ip in x, node_etcd_name.to_list()))[0]
-                # except:
-                #     assume order in the list is correct
-                #     node_name=node_etcd_name[idx]
-                # assume order in the list is correct
-                node_name=node_etcd_name[idx]
-                alias_map[node_name]=cp_nodes_list[idx]
-                alias_map[node_ip]=cp_nodes_list[idx]
-
-            rename_map={}
-            for item in etcd_object_counts_cols:
-                for key in alias_map.keys():
-                    if key in item:
-                        rename_map[item]=alias_map[key]+"_etcd_object_counts"
+            self.cast_plans.setdefault(tuple(plan['columns']), plan['dtypes'])
+        return plan
 
-            for item in etcd_failed_proposal_cols:
-                for key in alias_map.keys():
-                    if key in item:
-                        rename_map[item]=alias_map[key]+"_etcd_failed_proposal"
+    def get_schema_plan(self, columns, verbose=True):
+        """
+        cached_schema_plan, exiting when the layout fails the control-plane or etcd checks
+        """
+        try:
+            return self.cached_schema_plan(columns, verbose)
+        except ValueError as e:
+            self.logger.error(f"Fatal Error. {e}")
+            sys.exit(1)
 
-            for item in etcd_network_peer_rtt_cols:
-                for key in alias_map.keys():
-                    if key in item:
-                        rename_map[item]=alias_map[key]+"_etcd_network_peer_rtt"
+    def apply_schema_plan(self, plan):
+        """
+        Rename the columns of self.df with the node reordering and etcd renaming of plan
+        """
+        rename_map={raw: plan['rename_map'].get(name, name)
+                    for raw, name in ((colname, plan['swap_map'].get(colname, colname)) for colname in self.df.columns)}
+        self.df=self.df.rename(columns={raw: name for raw, name in rename_map.items() if raw != name})
 
-            for item in etcd_fsync_duration_cols:
-                for key in alias_map.keys():
-                    if key in item:
-                        rename_map[item]=alias_map[key]+"_etcd_fsync_duration"
-            
-            self.df.rename(columns = rename_map, inplace = True)
-            self.logger.debug(f"[{inspect.stack()[0][3]}] Completing feature name normalization.")
+    def projection_plan(self, raw_cols, drop=None, keep=None, labels=False):
+        """
+        Resolve a drop/keep column spec (regexes over the normalized names, see
+        filter_columns) against a raw column layout before reading it.
+        With labels, the columns impute_y_label reads are selected as well.
+        Returns (schema plan of the full layout, raw columns to read)
+        """
+        plan=self.get_schema_plan(raw_cols)
+        names=[plan['rename_map'].get(name, name) for name in (plan['swap_map'].get(colname, colname) for colname in raw_cols)]
+        selected=set(filter_columns(names, drop, keep))
+        if labels:
+            label_re=re.compile(self.transformer().label_columns())
+            selected.update(name for name in names if label_re.search(name))
+        return plan, [raw for raw, name in zip(raw_cols, names) if name in selected]
+
+    def transformer(self):
+        return DataTransformation(self.y_label_yellow, self.y_label_red, self.y_label_red_fatal,
+                                  logger=self.logger, metrics=self.metrics)
 
-    def load_dataset(self, fname: str, randomize_nodes=False):
+    def load_dataset(self, fname: str, randomize_nodes=False, drop=None, keep=None, label_weight=None, labels=False,
+                     row_filter=None):
         """
         load and clean raw dataset by:
             filling missing values with 0
             reseting index to avoid an index of 0 for all entries
             normalizing column names to remove cluster specific information
             setting columns data types
+
+        Projection (e.g. drop=DROP_COLUMNS for the get_clean_dataset columns):
+            drop, keep      regexes of normalized column names, resolved against the Parquet
+                            schema so the columns left out are never read
+            label_weight    impute y_label (impute_y_label) while the label columns are loaded,
+                            then discard those outside drop/keep
+            labels          read the label columns without imputing y_label (to label a combination
+                            of datasets, as load_and_combine_datasets)
+
+        Selection:
+            row_filter      CollectionFilter pushed into the Parquet read, row groups outside the
+                            run_id range are skipped (files are selected with row_filter.select_files)
         """
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Loading dataset.")
-        self.df=pd.read_parquet(fname, engine='pyarrow') # load raw dataset
-        self.df.fillna(value=0, inplace=True) # Replace None or NaN with 0
-        self.df.reset_index(drop=True, inplace=True) # reset index inplace
-        self.fix_node_ordering()
-        self.feature_name_normalization()
-        self.set_dtypes()
-        if not 'source' in self.df.columns:
-            self.df['source']=str(fname).split('/')[-1] # embed source file name as attribute
-        if randomize_nodes:
-            self.randomize_nodes()
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Processed {fname} with shape {self.df.shape}")
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Dataset loaded.\n{self.df.head()}")
-
-    def load_and_combine_datasets(self, file_names: list):
-        self.logger.debug(f"[{inspect.stack()[0][3]}] Loading and combining {len(file_names)} datasets.")
-        self.combined_df = pd.DataFrame()
-        for fname in file_names:
-            self.load_dataset(fname)
-            #self.df['source']=str(fname).split('/')[-1] # embed source file name as attribute
-            self.combined_df=pd.concat([self.combined_df,self.df], ignore_index=True)
-            print(self.combined_df.shape)
-        self.combined_df.fillna(value=0, inplace=True) # Replace None or NaN with 0
-        self.df=self.combined_df.copy()
-        # when combining datasets with different boolean features, missing values are set to 0
-        # on prevous step. We need to change booleans from 0 to False
-        self.set_dtypes()
+        self.logger.debug("Loading dataset.")
+        projected=drop is not None or keep is not None
+        labels=labels or label_weight is not None
+        variant=f"drop={drop}|keep={keep}|labels={labels}|label_weight={label_weight}" if projected or label_weight is not None else ""
+        if row_filter is not None:
+            variant+=f"|{row_filter}"
+        cached=self.cached_table(fname, variant)
+        if cached is not None:
+            with self.metrics.stage("load_cached", file=str(fname)) as stage:
+                self.df=cached.to_pandas(split_blocks=True) # numeric columns stay on the memory map
+                if randomize_nodes:
+                    self.randomize_nodes()
+                stage.observe(self.df)
+            self.logger.debug(f"Loaded {fname} from the wrangle cache with shape {self.df.shape}")
+            return
+
+        with self.metrics.stage("load_dataset", file=str(fname)) as stage:
+            columns=None
+            filters=None
+            if projected or row_filter is not None:
+                schema=pq.read_schema(fname)
+                if projected:
+                    plan, columns=self.projection_plan(self.source_columns(schema), drop, keep, labels)
+                if row_filter is not None:
+                    filters=row_filter.expression(schema)
+            with self.metrics.stage("read_parquet", file=str(fname)) as read_stage:
+                self.df=pd.read_parquet(fname, engine='pyarrow', columns=columns, filters=filters) # load raw dataset
+                read_stage.observe(self.df)
+            self.df.fillna(value=0, inplace=True) # Replace None or NaN with 0
+            self.df.reset_index(drop=True, inplace=True) # reset index inplace
+            # node reordering and etcd renaming through the cached schema plan
+            # (of the full layout when projected, the checks need the role and etcd columns)
+            self.apply_schema_plan(plan if projected else self.get_schema_plan(self.df.columns))
+            with self.metrics.stage("set_dtypes", file=str(fname)):
+                self.set_dtypes()
+            if not 'source' in self.df.columns:
+                self.df['source']=str(fname).split('/')[-1] # embed source file name as attribute
+            if label_weight is not None:
+                self.df=self.transformer().impute_y_label_and_drop(self.df, label_weight, drop, keep)
+            self.cache_table(fname, lambda: pa.Table.from_pandas(self.df, preserve_index=False), variant)
+            if randomize_nodes:
+                self.randomize_nodes()
+            stage.observe(self.df)
+        self.logger.debug(f"Processed {fname} with shape {self.df.shape}")
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"Dataset loaded.\n{self.df.head()}")
+
+    def cached_table(self, fname: str, variant=""):
+        """
+        Return the wrangled table of fname (and projection variant) from the wrangle cache,
+        None when disabled or missing
+        """
+        if self.wrangle_cache is None:
+            return None
+        return self.wrangle_cache.get(self.wrangle_cache.key(fname, variant))
+
+    def cache_table(self, fname: str, make_table, variant=""):
+        """
+        Store the wrangled table of fname (built by make_table) in the wrangle cache, if enabled
+        """
+        if self.wrangle_cache is not None:
+            self.wrangle_cache.put(self.wrangle_cache.key(fname, variant), make_table())
+
+    def wrangle_file(self, fname: str, drop=None, keep=None, labels=False, row_filter=None):
+        """
+        Load and normalize a single dataset and return the resulting DataFrame
+        """
+        self.load_dataset(fname, drop=drop, keep=keep, labels=labels, row_filter=row_filter)
+        return self.df
+
+    def select_files(self, file_names: list, row_filter=None):
+        """
+        Return the files of file_names selected by row_filter (all when None)
+        """
+        if row_filter is None:
+            return file_names
+        selected=row_filter.select_files(file_names)
+        self.logger.info(f"{len(selected)} of {len(file_names)} sources selected by {row_filter}.")
+        return selected
+
+    def compact_dataset(self):
+        """
+        Store self.df with categoricals for source/y_label and downcast numeric columns
+        (see DataTransformation.compact_dataset)
+        """
+        self.df=DataTransformation(logger=self.logger).compact_dataset(self.df)
+
+    def iter_wrangled(self, file_names: list, workers=1, drop=None, keep=None, labels=False, row_filter=None):
+        """
+        Yield (fname, DataFrame) for every dataset in file_names, normalized in
+        worker processes when workers > 1
+        """
+        projection = {'drop': drop, 'keep': keep, 'labels': labels, 'row_filter': row_filter}
+        if workers > 1 and len(file_names) > 1:
+            self.logger.debug(f"Using {workers} worker processes.")
+            if self.wrangle_cache is not None:
+                # hash the sources once here, the workers read the saved index
+                self.wrangle_cache.record(file_names)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(self.mapping_set, self.y_map_set, self.logger, self.dstdir,
+                                               self.plan_cache_dir, self.metrics.enabled,
+                                               self.wrangle_cache_dir, self.compiled)) as pool:
+                for fname, (df, records) in zip(file_names, pool.map(_wrangle_in_worker, file_names, repeat(projection))):
+                    self.metrics.extend(records)
+                    yield fname, df
+        else:
+            for fname in file_names:
+                yield fname, self.wrangle_file(fname, **projection)
+
+    def load_and_combine_datasets(self, file_names: list, workers=1, drop=None, keep=None, label_weight=None,
+                                  row_filter=None, dedup=False):
+        """
+        Load every dataset in file_names and combine them into a single DataFrame.
+
+        workers     number of processes used to load the datasets. With workers > 1 each
+                    file is normalized in its own process and the per-file frames are
+                    concatenated once at the end, same as the serial path.
+        drop, keep, label_weight
+                    column projection applied while reading each file (see load_dataset).
+                    y_label is imputed on the combined dataset, so the number of yy columns
+                    is the one of all datasets as when labeling the combined dataset.
+        row_filter  CollectionFilter selecting the files and rows to load (see load_dataset)
+        dedup       drop the rows duplicated on the get_clean_dataset columns, as in stream_datasets
+                    (see RowDeduplicator clean), after labeling
+        """
+        file_names = self.select_files(file_names, row_filter)
+        self.logger.debug(f"Loading and combining {len(file_names)} datasets.")
+        frames = [df for _, df in self.iter_wrangled(file_names, workers, drop, keep, labels=label_weight is not None,
+                                                     row_filter=row_filter)]
+        with self.metrics.stage("combine_datasets", files=len(file_names)) as stage:
+            # single concat instead of growing the accumulator once per file
+            self.combined_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+            del frames
+            self.combined_df.fillna(value=0, inplace=True) # Replace None or NaN with 0
+            self.df=self.combined_df.copy()
+            # when combining datasets with different boolean features, missing values are set to 0
+            # on prevous step. We need to change booleans from 0 to False
+            self.set_dtypes()
+            stage.observe(self.df)
+        if label_weight is not None:
+            self.df=self.transformer().impute_y_label_and_drop(self.df, label_weight, drop, keep)
+        if dedup:
+            with self.metrics.stage("deduplicate") as stage:
+                self.df=RowDeduplicator(clean=True).filter(self.df)
+                stage.observe(self.df)
         # print(self.df.head())
         # print(self.df.dtypes)
         print(f"{self.combined_df.shape} vs {self.combined_df.shape}")
-        self.logger.debug(f"[{inspect.stack()[0][3]}] All datasets loaded and combined.")
+        self.logger.debug("All datasets loaded and combined.")
+
+    def incremental_update(self, file_names: list, dataset_name: str, use_hash=False, workers=1,
+                           compression="snappy", compression_level=None, dedup=False, row_group_size=None):
+        """
+        Wrangle only new or changed sources into the partitioned dataset dstdir/dataset_name.
+
+        A manifest (dstdir/<dataset_name>.manifest.json) records size, mtime, optional content
+        hash and mapping hash of every wrangled source. Sources that changed since the last run
+        have their previous files replaced; untouched sources are skipped.
+        With dedup, rows already written by any source (in this or earlier runs) are dropped,
+        comparing the columns kept by get_clean_dataset (see RowDeduplicator clean);
+        the row hashes are kept in dstdir/<dataset_name>.hashes.npz.
+        row_group_size limits the rows per Parquet row group.
+        Returns the list of sources processed.
+        """
+        root=self.dstdir+"/"+dataset_name
+        manifest=Manifest(self.dstdir+"/"+dataset_name+".manifest.json", use_hash=use_hash)
+        deduplicator=RowDeduplicator(self.dstdir+"/"+dataset_name+".hashes.npz", clean=True) if dedup else None
+        pending=[fname for fname in file_names if not manifest.is_current(fname, self.mapping_hash)]
+        self.logger.info(f"{len(pending)} of {len(file_names)} sources require wrangling.")
+
+        for fname, df in self.iter_wrangled(pending, workers):
+            for old_file in manifest.files(fname):
+                if os.path.exists(old_file):
+                    os.remove(old_file)
+            if deduplicator is not None:
+                deduplicator.forget(str(fname))
+                df=deduplicator.filter(df, key=str(fname))
+            written=[]
+            stem=hashlib.sha256(str(fname).encode()).hexdigest()[:16]
+            with self.metrics.stage("write_partition", file=str(fname)) as stage:
+                pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), root,
+                                    partition_cols=['source'], basename_template=f"{stem}-{{i}}.parquet",
+                                    existing_data_behavior='overwrite_or_ignore', row_group_size=row_group_size,
+                                    **self.parquet_write_options(df.drop(columns=['source']), compression, compression_level),
+                                    file_visitor=lambda written_file: written.append(written_file.path))
+                stage.observe(df)
+            manifest.update(fname, self.mapping_hash, written)
+            if deduplicator is not None:
+                deduplicator.save()
+            manifest.save()
+            self.logger.debug(f"Wrangled {fname} into {written}")
+
+        manifest.save()
+        self.df=pd.DataFrame()
+        return pending
+
+    def load_wrangled_dataset(self, path: str, row_filter=None):
+        """
+        Load a partitioned dataset written by incremental_update into self.df.
+        Partitions with different column sets are unified and missing values set to 0.
+        row_filter (CollectionFilter) is pushed into the scan: source partitions and row
+        groups outside the run_id range are skipped.
+        """
+        self.logger.debug(f"Loading wrangled dataset {path}.")
+        dataset=open_wrangled_dataset(path)
+        filters=row_filter.expression(dataset.schema) if row_filter is not None else None
+        table=dataset.to_table(filter=filters)
+        if DATE_PARTITION in table.column_names:
+            table=table.drop_columns([DATE_PARTITION])
+        self.df=table.to_pandas()
+        self.df.fillna(value=0, inplace=True) # Replace None or NaN with 0
+        self.set_dtypes()
+        self.logger.debug(f"Loaded wrangled dataset with shape {self.df.shape}")
+
+    def source_columns(self, schema):
+        """
+        Return the data columns of a Parquet schema, leaving out stored pandas index columns
+        """
+        index_cols=[]
+        if schema.pandas_metadata:
+            index_cols=[col for col in schema.pandas_metadata.get('index_columns', []) if isinstance(col, str)]
+        return [colname for colname in schema.names if colname not in index_cols]
+
+    def plan_stream_schema(self, file_names: list, drop=None, keep=None, labels=False):
+        """
+        Resolve the schema plan of every file from its Parquet footer and the unified output
+        columns, in the same order pd.concat would produce them.
+        With a drop/keep spec only the projected raw columns are listed (see projection_plan).
+        Returns ({fname: (raw_columns, plan)}, unified_columns)
+        """
+        projected = drop is not None or keep is not None
+        file_plans = {}
+        unified = {}
+        for fname in file_names:
+            raw_cols=self.source_columns(pq.read_schema(fname))
+            if projected:
+                plan, raw_cols=self.projection_plan(raw_cols, drop, keep, labels)
+                read=set(plan['rename_map'].get(name, name) for name in (plan['swap_map'].get(colname, colname) for colname in raw_cols))
+                unified.update(dict.fromkeys(colname for colname in plan['columns'] if colname in read))
+            else:
+                plan=self.get_schema_plan(raw_cols)
+                unified.update(dict.fromkeys(plan['columns']))
+            file_plans[fname]=(raw_cols, plan)
+            unified['source']=None
+        return file_plans, list(unified.keys())
+
+    def validate_schema(self, fname: str):
+        """
+        Check fname against the mapping from its Parquet footer only (no data page is read):
+            error       unreadable footer or failed control-plane/etcd check
+            missing     normalized column names without a dtype in the mapping
+            conflicts   columns whose stored type cannot be cast to the mapped dtype
+            kinds       {normalized column: Arrow kind} for cross-file comparison
+        """
+        result={'file': str(fname), 'error': None, 'missing': [], 'conflicts': [], 'kinds': {}}
+        try:
+            schema=pq.read_schema(fname)
+            raw_cols=self.source_columns(schema)
+            _, _, names=self.resolve_columns(raw_cols, verbose=False)
+        except (ValueError, OSError, pa.ArrowException) as e:
+            result['error']=str(e)
+            return result
+
+        for raw, colname in zip(raw_cols, names):
+            kind=arrow_kind(schema.field(raw).type)
+            result['kinds'][colname]=kind
+            mapped_colname=self.map_colname(colname)
+            mapped_dtype=self.dtypes_maps.get(mapped_colname)
+            if mapped_dtype is None:
+                result['missing'].append(mapped_colname)
+            elif not dtype_accepts(mapped_dtype, kind):
+                result['conflicts'].append(f"{colname}({raw}): {schema.field(raw).type} -> {mapped_dtype}")
+        return result
+
+    def validate_schemas(self, file_names: list, workers=1):
+        """
+        Validate the mapping against every file in file_names from the Parquet footers,
+        in worker processes when workers > 1, and print a report.
+        Besides the per-file checks of validate_schema, columns stored with different
+        kinds across files are reported.
+        Returns the number of issues found.
+        """
+        self.logger.debug(f"Validating {len(file_names)} schemas.")
+        if workers > 1 and len(file_names) > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(self.mapping_set, self.y_map_set, self.logger, self.dstdir,
+                                               self.plan_cache_dir, False, None, self.compiled)) as pool:
+                results=list(pool.map(_validate_in_worker, file_names,
+                                      chunksize=max(1, len(file_names) // (workers * 8))))
+        else:
+            results=[self.validate_schema(fname) for fname in file_names]
+
+        failed={}
+        missing={}
+        conflicts=[]
+        kinds={}
+        for result in results:
+            if result['error'] is not None:
+                failed[result['file']]=result['error']
+                continue
+            for mapped_colname in result['missing']:
+                missing.setdefault(mapped_colname, []).append(result['file'])
+            conflicts.extend(f"{result['file']}: {conflict}" for conflict in result['conflicts'])
+            for colname, kind in result['kinds'].items():
+                if kind is not None:
+                    kinds.setdefault(colname, {}).setdefault(kind, result['file'])
+        mixed={colname: found for colname, found in kinds.items() if len(found) > 1}
+
+        print(f"Validated {len(results)} files.")
+        for fname, error in failed.items():
+            print(f"  failed {fname}: {error}")
+        for mapped_colname, files in missing.items():
+            print(f"  missing dtype map for {mapped_colname} in {len(files)} files (e.g. {files[0]})")
+        for conflict in conflicts:
+            print(f"  type conflict {conflict}")
+        for colname, found in mixed.items():
+            print(f"  mixed types for {colname}: " + ", ".join(f"{kind} (e.g. {fname})" for kind, fname in found.items()))
+        issues=len(failed)+len(missing)+len(conflicts)+len(mixed)
+        print(f"{issues} issues found.")
+        return issues
+
+    def stream_datasets(self, file_names: list, file_name: str, batch_size=65536,
+                        compression="snappy", compression_level=None, dedup=False,
+                        drop=None, keep=None, label_weight=None, row_filter=None, row_group_size=None):
+        """
+        Wrangle file_names batch by batch and append them to a single Parquet file.
+
+        Each source is read by row-group batches, normalized and typed like load_and_combine_datasets
+        and written through a ParquetWriter against the unified output schema, so peak memory
+        stays proportional to one batch. With dedup, duplicated rows are dropped across
+        batches and sources through the row hashes of the columns kept by get_clean_dataset
+        (see RowDeduplicator clean).
+        drop, keep and label_weight project the columns read and row_filter selects the files
+        and rows as in load_dataset. row_group_size limits the rows per row group; every
+        batch is written as at least one row group.
+        """
+        file_names = self.select_files(file_names, row_filter)
+        self.logger.debug(f"Streaming {len(file_names)} datasets with batch size {batch_size}.")
+        file_plans, columns = self.plan_stream_schema(file_names, drop, keep, labels=label_weight is not None)
+        schema = self.arrow_schema(columns)
+        if label_weight is not None:
+            transformer = self.transformer()
+            # columns once impute_y_label_and_drop added the labels and applied the spec
+            schema = self.arrow_schema(filter_columns(columns + list(LABEL_DTYPES), drop, keep))
+        deduplicator = RowDeduplicator(clean=True) if dedup else None
+
+        fname=self.dstdir+"/"+file_name
+        rows=0
+        options=self.parquet_write_options(schema.empty_table().to_pandas(), compression, compression_level)
+        with pq.ParquetWriter(fname, schema, **options) as writer:
+            for src in file_names:
+                raw_cols, plan = file_plans[src]
+                with self.metrics.stage("stream_file", file=str(src)):
+                    for batch in self.iter_source_batches(src, raw_cols, batch_size, row_filter):
+                        self.df=batch.to_pandas()
+                        self.df.fillna(value=0, inplace=True) # Replace None or NaN with 0
+                        self.apply_schema_plan(plan)
+                        if not 'source' in self.df.columns:
+                            self.df['source']=str(src).split('/')[-1] # embed source file name as attribute
+                        # columns missing from this source are filled with 0 as in the combined path
+                        self.df=self.df.reindex(columns=columns, fill_value=0)
+                        self.set_dtypes()
+                        if label_weight is not None:
+                            self.df=transformer.impute_y_label_and_drop(self.df, label_weight, drop, keep)
+                        if deduplicator is not None:
+                            self.df=deduplicator.filter(self.df)
+                        writer.write_table(pa.Table.from_pandas(self.df, schema=schema, preserve_index=False),
+                                           row_group_size=row_group_size)
+                        rows+=self.df.shape[0]
+                self.logger.debug(f"Streamed {src}.")
+        self.df=pd.DataFrame()
+        print(f"({rows}, {len(schema)})")
+        self.logger.debug(f"Saved {rows} rows to {fname}")
+
+
+    def iter_source_batches(self, fname: str, columns: list, batch_size=65536, row_filter=None):
+        """
+        Yield the record batches of columns in fname, scanned through pyarrow.dataset with the
+        row_filter expression when given (skipping the row groups it excludes)
+        """
+        filters = row_filter.expression(pq.read_schema(fname)) if row_filter is not None else None
+        if filters is None:
+            yield from pq.ParquetFile(fname).iter_batches(batch_size=batch_size, columns=columns)
+        else:
+            yield from ds.dataset(fname, format="parquet").to_batches(columns=columns, filter=filters,
+                                                                      batch_size=batch_size)
+
+    def arrow_schema(self, columns):
+        """
+        Return the Arrow schema (with pandas metadata) matching the cast plan of columns
+        """
+        key = tuple(columns)
+        if key not in self.arrow_schemas:
+            dtypes = self.build_cast_plan(key)
+            schema = pa.Schema.from_pandas(
+                pd.DataFrame({colname: pd.Series(dtype=dtype) for colname, dtype in dtypes.items()}),
+                preserve_index=False)
+            # empty object columns (e.g. 'str' on pandas < 3) have no Arrow type, they hold strings
+            for pos, field in enumerate(schema):
+                if pa.types.is_null(field.type):
+                    schema = schema.set(pos, field.with_type(pa.string()))
+            self.arrow_schemas[key] = schema
+        return self.arrow_schemas[key]
+
+    def fill_null_table(self, table: pa.Table):
+        """
+        Arrow counterpart of fillna(value=0): replace nulls with 0 in each column type
+        """
+        columns = []
+        for col in table.columns:
+            if col.null_count > 0 and not pa.types.is_null(col.type):
+                col = pc.fill_null(col, pa.scalar(0).cast(col.type))
+            columns.append(col)
+        return pa.Table.from_arrays(columns, schema=table.schema)
+
+    def cast_table(self, table: pa.Table):
+        """
+        Arrow counterpart of set_dtypes: cast every column with the cast plan in one pass
+        """
+        schema = self.arrow_schema(table.column_names)
+        columns = []
+        for field, col in zip(schema, table.columns):
+            if pa.types.is_timestamp(field.type) and (pa.types.is_string(col.type) or pa.types.is_large_string(col.type)):
+                col = pc.strptime(col, format=TIMESTAMP_FORMAT, unit="ns")
+            columns.append(col.cast(field.type, safe=False))
+        return self.fill_null_table(pa.Table.from_arrays(columns, schema=schema))
+
+    def load_table(self, fname: str, row_filter=None):
+        """
+        Arrow-native load_dataset: read, fill nulls, rename and cast fname as a pyarrow.Table
+        without converting it to pandas
+        """
+        self.logger.debug(f"Loading table {fname}.")
+        variant = f"|{row_filter}" if row_filter is not None else ""
+        cached = self.cached_table(fname, variant)
+        if cached is not None:
+            self.logger.debug(f"Loaded {fname} from the wrangle cache with shape {cached.shape}")
+            return cached
+        with self.metrics.stage("load_table", file=str(fname)) as stage:
+            schema = pq.read_schema(fname)
+            table = pq.read_table(fname, columns=self.source_columns(schema),
+                                  filters=row_filter.expression(schema) if row_filter is not None else None)
+            plan = self.get_schema_plan(table.column_names)
+            table = self.fill_null_table(table)
+            # zero-copy renaming through the schema plan
+            table = table.rename_columns([plan['rename_map'].get(name, name)
+                                          for name in (plan['swap_map'].get(colname, colname) for colname in table.column_names)])
+            if not 'source' in table.column_names:
+                table = table.append_column('source', pa.repeat(pa.scalar(str(fname).split('/')[-1]), table.num_rows))
+            table = self.cast_table(table)
+            self.cache_table(fname, lambda: table, variant)
+            stage.observe(table)
+        self.logger.debug(f"Processed {fname} with shape {table.shape}")
+        return table
+
+    def load_and_combine_tables(self, file_names: list, row_filter=None):
+        """
+        Arrow-native load_and_combine_datasets. The combined data is kept in self.table
+        until to_dataframe is called.
+        """
+        file_names = self.select_files(file_names, row_filter)
+        self.logger.debug(f"Loading and combining {len(file_names)} tables.")
+        tables = [self.load_table(fname, row_filter) for fname in file_names]
+        with self.metrics.stage("combine_tables", files=len(file_names)) as stage:
+            if tables:
+                # missing columns become nulls, filled with 0 and cast like the pandas path
+                self.table = self.cast_table(pa.concat_tables(tables, promote_options="default"))
+            else:
+                self.table = pa.table({})
+            stage.observe(self.table)
+        print(self.table.shape)
+        self.logger.debug("All tables loaded and combined.")
+
+    def to_dataframe(self):
+        """
+        Materialize self.table as the pandas DataFrame self.df
+        """
+        self.df = self.table.to_pandas()
+        return self.df
+
+    def write_table(self, file_name: str, compression="snappy", compression_level=None, row_group_size=None):
+        """
+        Write self.table to dstdir/file_name without converting it to pandas
+        """
+        self.logger.debug(f"Saving table to {self.dstdir} with name {file_name}.")
+        fname=self.dstdir+"/"+file_name
+        options=self.parquet_write_options(self.table.schema.empty_table().to_pandas(), compression, compression_level)
+        with self.metrics.stage("write_table", file=file_name) as stage:
+            pq.write_table(self.table, fname, row_group_size=row_group_size, **options)
+            stage.observe(self.table)
+        self.logger.debug(f"Saved {file_name} table to {fname}")
+
+    def parquet_write_options(self, df, compression="snappy", compression_level=None):
+        """
+        Parquet writer options: codec and level, dictionary encoding for string columns
+        and column statistics so readers can skip row groups
+        """
+        string_cols=[colname for colname in df.columns
+                     if pd.api.types.is_string_dtype(df[colname]) or isinstance(df[colname].dtype, pd.CategoricalDtype)]
+        return {
+            'compression': compression,
+            'compression_level': compression_level,
+            'use_dictionary': string_cols,
+            'write_statistics': True,
+        }
 
-    def write_dataset(self, file_name: str):
+    def to_long_layout(self):
+        """
+        Return self.df in the node-as-row layout (see LongLayout), LongLayout.to_wide pivots it back
+        """
+        with self.metrics.stage("to_long_layout") as stage:
+            layout=LongLayout.from_wide(self.df)
+            stage.observe(layout.nodes)
+        return layout
+
+    def write_long_layout(self, file_name: str, compression="snappy", compression_level=None, row_group_size=None):
+        """
+        Write self.df in the node-as-row layout to the directory dstdir/file_name
+        (nodes.parquet and cluster.parquet)
+        """
+        self.logger.debug(f"Saving long layout to {self.dstdir} with name {file_name}.")
+        fname=self.dstdir+"/"+file_name
+        layout=self.to_long_layout()
+        with self.metrics.stage("write_long_layout", file=file_name) as stage:
+            layout.write(fname, row_group_size=row_group_size,
+                         **self.parquet_write_options(layout.nodes, compression, compression_level))
+            stage.observe(layout.nodes)
+        self.logger.debug(f"Saved {layout.nodes.shape[0]} node rows and {layout.cluster.shape[0]} cluster rows to {fname}")
+
+    def write_dataset(self, file_name: str, partition_cols=None, partition_by_date=False,
+                      compression="snappy", compression_level=None, row_group_size=None, sort_by=None):
+        """
+        Write self.df to dstdir/file_name.
+
+        partition_cols      hive-partition the output directory by these columns (e.g. ['source'])
+        partition_by_date   also partition by the run_id date (run_date=YYYY-MM-DD)
+        compression         parquet codec (snappy, zstd, gzip, brotli, lz4, none)
+        compression_level   codec level, codec default when None
+        row_group_size      maximum rows per row group
+        sort_by             column(s) to sort rows by before writing (e.g. 'run_id')
+        """
         self.logger.debug(f"Saving data to {self.dstdir} with name {file_name}.")
         fname=self.dstdir+"/"+file_name
-        self.df.to_parquet(fname, compression="snappy")
-        self.logger.debug(f"Saved {file_name} DataFrame to {fname}")
+        with self.metrics.stage("write_dataset", file=file_name) as stage:
+            df=self.df
+            if sort_by is not None:
+                df=df.sort_values(sort_by, kind="stable", ignore_index=True)
+            options=self.parquet_write_options(df, compression, compression_level)
 
+            if not partition_cols and not partition_by_date:
+                df.to_parquet(fname, row_group_size=row_group_size, **options)
+            else:
+                partition_cols=list(partition_cols or [])
+                table=pa.Table.from_pandas(df, preserve_index=False)
+                if partition_by_date:
+                    table=table.append_column(DATE_PARTITION, pa.array(df['run_id'].dt.strftime("%Y-%m-%d"), type=pa.string()))
+                    partition_cols.append(DATE_PARTITION)
+                options['use_dictionary']=[colname for colname in options['use_dictionary'] if colname not in partition_cols]
+                ds.write_dataset(table, fname, format="parquet",
+                                 partitioning=partition_cols, partitioning_flavor="hive",
+                                 file_options=ds.ParquetFileFormat().make_write_options(**options),
+                                 max_rows_per_group=row_group_size or (1 << 20),
+                                 min_rows_per_group=row_group_size or 0,
+                                 max_partitions=1 << 16,
+                                 existing_data_behavior="delete_matching")
+            stage.observe(df)
+        self.logger.debug(f"Saved {file_name} DataFrame to {fname}")
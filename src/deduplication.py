@@ -0,0 +1,139 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+from .collection_filter import CLUSTER_TYPES
+from .data_transformation import DROP_COLUMNS
+from .file_utils import atomic_write
+
+# columns y_label is imputed from, part of the clean key while y_label is not imputed yet
+LABEL_SOURCE_COLUMNS = re.compile("yy")
+
+class RowDeduplicator:
+    """
+    Hash-based row deduplication across batches and runs.
+
+    Each row gets a 64-bit fingerprint (pd.util.hash_pandas_object). A row is dropped when
+    its fingerprint was already seen in the same batch or in any earlier one, which gives
+    the result of drop_duplicates() without holding every row in memory. Seen hashes are
+    grouped by key (e.g. the source file) so a replaced source can be forgotten, and are
+    persisted to path (.npz) when one is given.
+
+    With clean=True rows are compared as get_clean_dataset compares them on the combined
+    dataset, so wrangled rows of different files (e.g. a copied source) match:
+        - only the columns kept by get_clean_dataset (not matching DROP_COLUMNS) are hashed,
+          plus the yy columns when y_label is not imputed yet, as they decide the label
+        - source is replaced by its cluster type as normalize_sources does
+        - columns that are 0 (False) do not change the fingerprint, as columns missing from
+          a source are 0 in the combined dataset
+
+    Seen hashes are kept in sorted runs merged when a run grows as large as the one before
+    it, so a lookup is a few binary searches instead of a scan of every hash seen.
+    """
+    def __init__(self, path=None, clean=False):
+        self.path = path
+        self.clean = clean
+        self.seen = {}  # key -> list of hash arrays recorded under key
+        self.runs = []  # sorted hash arrays of all keys, decreasing sizes
+        self.load()
+
+    def load(self):
+        if self.path and os.path.exists(self.path):
+            with np.load(self.path) as stored:
+                self.seen = {str(key): [stored[f"arr_{idx}"]] for idx, key in enumerate(stored['keys'])}
+        self.rebuild()
+
+    def save(self):
+        if not self.path:
+            return
+        with atomic_write(self.path, suffix=".tmp.npz") as tmp:
+            np.savez(tmp, *[np.concatenate(chunks) for chunks in self.seen.values()],
+                     keys=np.array(list(self.seen.keys()), dtype=str))
+
+    def rebuild(self):
+        """
+        Rebuild the sorted runs from the hashes recorded under every key
+        """
+        chunks = [chunk for key_chunks in self.seen.values() for chunk in key_chunks]
+        hashes = np.sort(np.concatenate(chunks)) if chunks else np.empty(0, dtype=np.uint64)
+        self.runs = [hashes] if hashes.size else []
+
+    def forget(self, key: str):
+        """
+        Drop the hashes recorded under key (e.g. before re-ingesting a changed source)
+        """
+        if self.seen.pop(key, None) is not None:
+            self.rebuild()
+
+    def contains(self, hashes):
+        """
+        Boolean mask of the hashes already seen
+        """
+        found = np.zeros(hashes.shape[0], dtype=bool)
+        for run in self.runs:
+            positions = np.minimum(np.searchsorted(run, hashes), run.shape[0] - 1)
+            found |= run[positions] == hashes
+        return found
+
+    def add(self, key: str, hashes):
+        """
+        Record hashes (sorted, unique and not seen yet) under key
+        """
+        self.seen.setdefault(key, []).append(hashes)
+        if not hashes.size:
+            return
+        self.runs.append(hashes)
+        while len(self.runs) > 1 and self.runs[-2].shape[0] <= 2 * self.runs[-1].shape[0]:
+            last = self.runs.pop()
+            # both runs are sorted: the stable sort merges them in linear time
+            self.runs[-1] = np.sort(np.concatenate([self.runs[-1], last]), kind='stable')
+
+    def fingerprint(self, df: pd.DataFrame):
+        if self.clean:
+            return self.clean_fingerprint(df)
+        return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+    def clean_fingerprint(self, df: pd.DataFrame):
+        """
+        Order independent fingerprint of the get_clean_dataset columns of df, summing one hash
+        per non-zero (column, value) pair
+        """
+        drop = re.compile(DROP_COLUMNS)
+        labeled = 'y_label' in df.columns
+        hashes = np.zeros(df.shape[0], dtype=np.uint64)
+        for colname in df.columns:
+            if drop.search(colname) and (labeled or not LABEL_SOURCE_COLUMNS.search(colname)):
+                continue
+            values = df[colname]
+            if colname == 'source':
+                values = self.cluster_types(values)
+            values = values.to_numpy()
+            column_hash = pd.util.hash_array(np.array([colname], dtype=object))[0]
+            cells = pd.util.hash_array(pd.util.hash_array(values) ^ column_hash)
+            if values.dtype.kind in 'biuf':
+                cells[values == 0] = 0
+            hashes += cells
+        return hashes
+
+    @staticmethod
+    def cluster_types(sources: pd.Series):
+        """
+        Source names replaced by their cluster type (see DataTransformation.normalize_sources)
+        """
+        sources = sources.astype(str)
+        for cluster_type, pattern in CLUSTER_TYPES.items():
+            sources = sources.mask(sources.str.contains(pattern, case=False), cluster_type)
+        return sources
+
+    def filter(self, df: pd.DataFrame, key="default"):
+        """
+        Return df without the rows already seen, recording the new hashes under key
+        """
+        hashes = self.fingerprint(df)
+        keep = ~pd.Series(hashes).duplicated().to_numpy()
+        if self.runs:
+            keep &= ~self.contains(hashes)
+        self.add(key, np.unique(hashes[keep]))
+        if keep.all():
+            return df
+        return df[keep]
@@ -0,0 +1,31 @@
+import os
+import hashlib
+from contextlib import contextmanager
+
+def file_hash(fname):
+    """
+    Return the sha256 hex digest of the content of fname, read in 1 MiB chunks
+    """
+    digest = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@contextmanager
+def atomic_write(path, suffix=".tmp"):
+    """
+    Yield a temporary path to write instead of path, moved onto path once the block exits.
+
+    The temporary name is per process, so concurrent workers writing the same entry never
+    read a partial file. suffix keeps writers that add an extension happy (np.savez needs
+    ".npz"). The temporary file is removed when the block raises.
+    """
+    tmp = f"{path}.{os.getpid()}{suffix}"
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
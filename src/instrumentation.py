@@ -0,0 +1,91 @@
+import os
+import csv
+import json
+import time
+import resource
+
+class _NullStage:
+    """
+    Stage returned when metrics are disabled: entering, observing and leaving are no-ops
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def observe(self, data):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    def __init__(self, metrics, name: str, labels: dict):
+        self.metrics = metrics
+        self.record = {'stage': name, **labels}
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.record['seconds'] = round(time.perf_counter() - self.start, 6)
+        # ru_maxrss is reported in KiB on Linux
+        self.record['peak_rss_mib'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        self.record['pid'] = os.getpid()
+        self.metrics.records.append(self.record)
+        return False
+
+    def observe(self, data):
+        """
+        Record rows, columns and bytes of a pandas DataFrame or pyarrow Table
+        """
+        if data is None:
+            return
+        self.record['rows'], self.record['columns'] = data.shape
+        if hasattr(data, 'nbytes'):
+            self.record['bytes'] = int(data.nbytes)
+        else:
+            self.record['bytes'] = int(data.memory_usage(index=False, deep=False).sum())
+
+class StageMetrics:
+    """
+    Low-overhead pipeline instrumentation.
+
+    Usage:
+        with metrics.stage("load_dataset", file=fname) as stage:
+            ...
+            stage.observe(df)
+
+    Each stage records its duration, peak RSS and the rows, columns and bytes observed.
+    When disabled, stage() returns a shared no-op context so the cost is a method call.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.records = []
+
+    def stage(self, name: str, **labels):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, labels)
+
+    def extend(self, records: list):
+        self.records.extend(records)
+
+    def pop_records(self):
+        records, self.records = self.records, []
+        return records
+
+    def write(self, path: str):
+        """
+        Write the records as CSV when path ends with .csv, otherwise as JSON
+        """
+        if path.endswith(".csv"):
+            fields = list(dict.fromkeys(key for record in self.records for key in record))
+            with open(path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(self.records)
+        else:
+            with open(path, "w") as f:
+                json.dump({'stages': self.records}, f, indent=2)
@@ -0,0 +1,160 @@
+import os
+import re
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# node columns of the wide layout: node<id>_<metric>, any number of nodes
+NODE_COLUMN = re.compile(r"^node(\d+)_(.+)$")
+NODE_KEYS = ['row', 'run_id', 'node', 'role']
+# schema metadata key holding the wide column order
+WIDE_COLUMNS_KEY = b"wide_columns"
+
+class LongLayout:
+    """
+    Node-as-row layout of a wide dataset.
+
+        nodes       one row per (wide row, node): row, run_id, node, role and one column per
+                    node metric (node<id>_<metric> columns without their prefix)
+        cluster     the cluster-wide columns, one row per wide row
+        columns     the wide column order, so to_wide returns the same columns in the same
+                    order and dtypes (metrics a node does not have are not created)
+
+    The width no longer grows with the node count and node reordering is a remap of the
+    node key (remap_nodes) instead of a rename of every node column.
+    role is 'control_plane' when the node control_plane metric is set, 'worker' otherwise.
+    """
+    def __init__(self, nodes: pd.DataFrame, cluster: pd.DataFrame, columns: list):
+        self.nodes = nodes
+        self.cluster = cluster
+        self.columns = list(columns)
+
+    @classmethod
+    def from_wide(cls, df: pd.DataFrame):
+        """
+        Split a wide DataFrame into its nodes and cluster tables
+        """
+        node_columns = {}
+        metrics = {}
+        for colname in df.columns:
+            match = NODE_COLUMN.match(colname)
+            if match:
+                node_columns.setdefault(int(match.group(1)), {})[match.group(2)] = colname
+                metrics.setdefault(match.group(2), df[colname].dtype)
+        cluster = df[[colname for colname in df.columns if not NODE_COLUMN.match(colname)]].reset_index(drop=True)
+        run_id = cluster['run_id'].to_numpy() if 'run_id' in cluster.columns else None
+
+        frames = []
+        for node in sorted(node_columns):
+            names = node_columns[node]
+            frame = df[list(names.values())].set_axis(list(names.keys()), axis=1).reset_index(drop=True)
+            missing = [metric for metric in metrics if metric not in names]
+            if missing:
+                # metrics of other nodes (e.g. control-plane only) are 0 for this node
+                frame = frame.reindex(columns=list(metrics), fill_value=0).astype(
+                    {metric: metrics[metric] for metric in missing})
+            role = np.where(frame['control_plane'].to_numpy(dtype=bool), 'control_plane', 'worker') \
+                if 'control_plane' in frame.columns else np.full(frame.shape[0], 'worker')
+            keys = pd.DataFrame({'row': np.arange(frame.shape[0], dtype=np.int64), 'run_id': run_id,
+                                 'node': np.full(frame.shape[0], node, dtype=np.uint32), 'role': role})
+            frames.append(pd.concat([keys, frame], axis=1))
+        if frames:
+            nodes = pd.concat(frames, ignore_index=True)
+        else:
+            nodes = pd.DataFrame(columns=NODE_KEYS + list(metrics))
+        return cls(nodes, cluster, df.columns)
+
+    def node_ids(self):
+        return sorted(int(node) for node in self.nodes['node'].unique())
+
+    def to_wide(self):
+        """
+        Pivot back to the wide layout with the original column order and dtypes
+        """
+        rows = self.cluster.shape[0]
+        metrics = [colname for colname in self.nodes.columns if colname not in NODE_KEYS]
+        wanted = set(self.columns)
+        frames = [self.cluster]
+        node_keys = self.nodes['node'].to_numpy()
+        for node in self.node_ids():
+            part = self.nodes[node_keys == node]
+            names = {metric: f"node{node}_{metric}" for metric in metrics if f"node{node}_{metric}" in wanted}
+            frame = part[list(names.keys())].set_axis(list(names.values()), axis=1)
+            positions = part['row'].to_numpy()
+            if positions.shape[0] == rows and (positions == np.arange(rows)).all():
+                frame = frame.reset_index(drop=True)
+            else:
+                # rows without this node are 0 as in the combined datasets
+                frame = frame.set_axis(positions, axis=0).reindex(np.arange(rows), fill_value=0).astype(frame.dtypes)
+            frames.append(frame)
+        wide = pd.concat(frames, axis=1)
+        return wide[[colname for colname in self.columns if colname in wide.columns]]
+
+    def remap_nodes(self, mapping: dict):
+        """
+        Rename node ids ({old: new}, e.g. a swap) on the node key and the wide column order
+        """
+        if not mapping:
+            return self
+        nodes = self.nodes['node'].to_numpy().astype(np.uint32)
+        if nodes.size:
+            # lookup[old] == new, identity for the ids outside the mapping
+            lookup = np.arange(max(int(nodes.max()), *mapping) + 1, dtype=np.uint32)
+            lookup[list(mapping.keys())] = list(mapping.values())
+            nodes = lookup[nodes]
+        self.nodes['node'] = nodes
+        renamed = []
+        for colname in self.columns:
+            match = NODE_COLUMN.match(colname)
+            if match and int(match.group(1)) in mapping:
+                colname = f"node{mapping[int(match.group(1))]}_{match.group(2)}"
+            renamed.append(colname)
+        self.columns = renamed
+        return self
+
+    def ordering_map(self):
+        """
+        Node id mapping that moves the control-plane nodes to the lowest ids, with the same
+        swaps as DataWrangle.node_ordering_swaps for any node count
+        """
+        control_plane = sorted({int(match.group(1)) for match in map(NODE_COLUMN.match, self.columns)
+                                if match and match.group(2) == 'control_plane'})
+        missing = [node for node in range(1, len(control_plane) + 1) if node not in control_plane]
+        extra = [node for node in control_plane if node > len(control_plane)]
+        mapping = {}
+        while missing:
+            nodeA, nodeB = missing.pop(), extra.pop()
+            mapping[nodeA] = nodeB
+            mapping[nodeB] = nodeA
+        return mapping
+
+    def order_nodes(self):
+        """
+        fix_node_ordering as a key remap
+        """
+        return self.remap_nodes(self.ordering_map())
+
+    def write(self, path: str, **options):
+        """
+        Write the layout to the directory path (nodes.parquet, cluster.parquet).
+        options are passed to pyarrow.parquet.write_table.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name, df in (('nodes', self.nodes), ('cluster', self.cluster)):
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            table = table.replace_schema_metadata({**table.schema.metadata,
+                                                   WIDE_COLUMNS_KEY: json.dumps(self.columns).encode()})
+            pq.write_table(table, os.path.join(path, f"{name}.parquet"), **options)
+
+    @classmethod
+    def read(cls, path: str, columns=None):
+        """
+        Read a layout written by write. columns optionally limits the node metrics read.
+        """
+        node_columns = None if columns is None else NODE_KEYS + [colname for colname in columns if colname not in NODE_KEYS]
+        nodes = pq.read_table(os.path.join(path, "nodes.parquet"), columns=node_columns)
+        cluster = pq.read_table(os.path.join(path, "cluster.parquet"))
+        wide_columns = json.loads(cluster.schema.metadata[WIDE_COLUMNS_KEY])
+        return cls(nodes.to_pandas(), cluster.to_pandas(), wide_columns)
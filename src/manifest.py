@@ -0,0 +1,64 @@
+import os
+import json
+from .file_utils import file_hash, atomic_write
+
+class Manifest:
+    """
+    Record of the sources already wrangled into an output dataset.
+
+    Each entry keeps the source path, size, mtime, optional content hash, the mapping
+    hash used to wrangle it and the files written for it, so later runs only need to
+    process new or changed sources.
+    """
+    def __init__(self, path: str, use_hash=False):
+        self.path = path
+        self.use_hash = use_hash
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.entries = json.load(f).get('sources', {})
+
+    def save(self):
+        with atomic_write(self.path) as tmp, open(tmp, "w") as f:
+            json.dump({'sources': self.entries}, f, indent=2, sort_keys=True)
+
+    def fingerprint(self, fname: str, mapping_digest: str):
+        stat = os.stat(fname)
+        entry = {
+            'path': str(fname),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'mapping_hash': mapping_digest,
+        }
+        if self.use_hash:
+            entry['sha256'] = file_hash(fname)
+        return entry
+
+    def is_current(self, fname: str, mapping_digest: str):
+        """
+        True when fname was already wrangled with the same content and mapping
+        """
+        entry = self.entries.get(str(fname))
+        if entry is None or entry.get('mapping_hash') != mapping_digest:
+            return False
+        stat = os.stat(fname)
+        if entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return True
+        # touched but possibly unchanged file, compare content when hashes are recorded
+        if self.use_hash and 'sha256' in entry and entry['size'] == stat.st_size:
+            if entry['sha256'] == file_hash(fname):
+                entry['mtime_ns'] = stat.st_mtime_ns
+                return True
+        return False
+
+    def files(self, fname: str):
+        entry = self.entries.get(str(fname))
+        return entry.get('files', []) if entry else []
+
+    def update(self, fname: str, mapping_digest: str, files: list):
+        entry = self.fingerprint(fname, mapping_digest)
+        entry['files'] = files
+        self.entries[str(fname)] = entry
@@ -0,0 +1,55 @@
+import os
+import json
+import hashlib
+from .file_utils import atomic_write
+
+def mapping_hash(mapping_set):
+    """
+    Return a stable hash of a loaded mapping (e.g. mapping.yaml)
+    """
+    payload = json.dumps(mapping_set, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class SchemaPlanCache:
+    """
+    Cache of column transformation plans (swap map, rename map and dtype plan).
+
+    Plans are keyed by a fingerprint of the raw column list plus the mapping hash,
+    kept in memory and, when cache_dir is set, persisted as JSON files so later
+    runs with the same schema skip rebuilding them.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.plans = {}
+        if self.cache_dir and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(columns, mapping_digest: str):
+        digest = hashlib.sha256()
+        digest.update(mapping_digest.encode())
+        for colname in columns:
+            digest.update(b"\x1f")
+            digest.update(str(colname).encode())
+        return digest.hexdigest()
+
+    def path(self, key: str):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str):
+        plan = self.plans.get(key)
+        if plan is None and self.cache_dir:
+            try:
+                with open(self.path(key), "r") as f:
+                    plan = json.load(f)
+                self.plans[key] = plan
+            except (OSError, ValueError):
+                return None
+        return plan
+
+    def put(self, key: str, plan: dict):
+        self.plans[key] = plan
+        if self.cache_dir:
+            # concurrent workers never read a partial plan
+            with atomic_write(self.path(key)) as tmp, open(tmp, "w") as f:
+                json.dump(plan, f)
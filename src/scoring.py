@@ -0,0 +1,191 @@
+import os
+import time
+import joblib
+import warnings
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .data_wrangling import DataWrangle
+from .file_utils import atomic_write
+
+# y_label names per encoded class (CustomML.encode_y, yellow merged into red for binary models)
+LABELS = ['green', 'red', 'yellow']
+BINARY_LABELS = ['green', 'red']
+
+def save_model_bundle(path: str, pipeline, X_train: pd.DataFrame, binary=False, mapping_hash=None):
+    """
+    Persist a fitted pipeline with the feature columns and dtypes it was trained on.
+    binary marks models trained on get_xy_logreg labels (green/red).
+    """
+    bundle = {
+        'pipeline': pipeline,
+        'features': X_train.columns.to_list(),
+        'dtypes': {colname: str(dtype) for colname, dtype in X_train.dtypes.items()},
+        'binary': binary,
+        'mapping_hash': mapping_hash,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with atomic_write(path) as tmp:
+        joblib.dump(bundle, tmp)
+
+def load_model_bundle(path: str):
+    return joblib.load(path)
+
+class Scorer:
+    """
+    Score raw collection files or live snapshots with a bundle saved by save_model_bundle.
+
+    Raw columns are normalized through the DataWrangle schema plans (optionally cached
+    on disk), so a known collection layout needs no regex work. Files are read in
+    batches of only the columns the model uses. Snapshots (one {raw column: value}
+    record) are mapped straight to the feature vector through a per-layout index.
+    """
+    def __init__(self, bundle_path: str, mapping_set, y_map_set, logger, plan_cache_dir=None, compiled=None):
+        self.logger = logger
+        self.bundle = load_model_bundle(bundle_path)
+        self.pipeline = self.bundle['pipeline']
+        self.features = self.bundle['features']
+        self.dtypes = self.bundle['dtypes']
+        self.labels = BINARY_LABELS if self.bundle['binary'] else LABELS
+        self.wrangler = DataWrangle(mapping_set, y_map_set, logger, plan_cache_dir=plan_cache_dir, compiled=compiled)
+        if self.bundle['mapping_hash'] and self.bundle['mapping_hash'] != self.wrangler.mapping_hash:
+            self.logger.warning("Model was trained with a different mapping.")
+        self.feature_index = {colname: pos for pos, colname in enumerate(self.features)}
+        self.proba = hasattr(self.pipeline, 'predict_proba')
+        # snapshot layouts: tuple(raw columns) -> (raw positions, feature positions)
+        self.layouts = {}
+        self.fast_path = self.compile_fast_path()
+
+    def compile_fast_path(self):
+        """
+        For a Pipeline starting with a ColumnTransformer over named columns (as built from
+        CustomML.feature_scaling_per_type), return ([(transformer, feature positions)], rest)
+        so a snapshot vector can skip the per-call DataFrame column selection.
+        Returns None for other pipelines.
+        """
+        from sklearn.pipeline import Pipeline
+        from sklearn.compose import ColumnTransformer
+        if not isinstance(self.pipeline, Pipeline) or not isinstance(self.pipeline.steps[0][1], ColumnTransformer):
+            return None
+        blocks = []
+        for name, transformer, cols in self.pipeline.steps[0][1].transformers_:
+            if transformer == 'drop':
+                continue
+            if not all(isinstance(colname, str) and colname in self.feature_index for colname in cols):
+                return None
+            blocks.append((transformer, np.array([self.feature_index[colname] for colname in cols], dtype=np.intp)))
+        rest = self.pipeline[1:] if len(self.pipeline.steps) > 2 else self.pipeline.steps[-1][1]
+        return blocks, rest
+
+    def normalized_names(self, raw_cols):
+        """
+        Return the normalized name of every raw column through the schema plan.
+        Raises ValueError when the layout fails the control-plane or etcd checks.
+        """
+        plan = self.wrangler.cached_schema_plan(raw_cols, verbose=False)
+        return [plan['rename_map'].get(name, name)
+                for name in (plan['swap_map'].get(colname, colname) for colname in raw_cols)]
+
+    def predictions(self, X: pd.DataFrame):
+        """
+        Return a DataFrame with the predicted y_label and, when available, one
+        probability column per label
+        """
+        codes = self.pipeline.predict(X).astype(np.int64)
+        result = {'y_pred': np.array(self.labels, dtype=object)[codes]}
+        if self.proba:
+            proba = self.pipeline.predict_proba(X)
+            for pos, code in enumerate(self.pipeline.classes_):
+                result[f"p_{self.labels[int(code)]}"] = proba[:, pos]
+        return pd.DataFrame(result, index=X.index)
+
+    def iter_scores(self, fname: str, batch_size=65536):
+        """
+        Yield the scores of fname batch by batch, with its source and run_id
+        """
+        raw_cols = self.wrangler.source_columns(pq.read_schema(fname))
+        names = self.normalized_names(raw_cols)
+        # projection: only the raw columns backing a model feature (and run_id)
+        columns = {raw: name for raw, name in zip(raw_cols, names) if name in self.feature_index or name == 'run_id'}
+        for batch in pq.ParquetFile(fname).iter_batches(batch_size=batch_size, columns=list(columns)):
+            df = batch.to_pandas().rename(columns=columns)
+            X = df.reindex(columns=self.features, fill_value=0).fillna(0).astype(self.dtypes)
+            scores = self.predictions(X)
+            scores.insert(0, 'run_id', df['run_id'].astype(str) if 'run_id' in df.columns else None)
+            scores.insert(0, 'source', os.path.basename(str(fname)))
+            yield scores
+
+    def score_files(self, file_names: list, fname: str, batch_size=65536):
+        """
+        Score every file in file_names in batches and write the results to the Parquet file fname.
+        Files whose layout fails the control-plane or etcd checks are logged and skipped.
+        Returns the number of rows scored.
+        """
+        schema = pa.schema([('source', pa.string()), ('run_id', pa.string()), ('y_pred', pa.string())] +
+                           ([(f"p_{self.labels[int(code)]}", pa.float64()) for code in self.pipeline.classes_]
+                            if self.proba else []))
+        rows = 0
+        with pq.ParquetWriter(fname, schema) as writer:
+            for src in file_names:
+                try:
+                    for scores in self.iter_scores(src, batch_size):
+                        writer.write_table(pa.Table.from_pandas(scores, schema=schema, preserve_index=False))
+                        rows += scores.shape[0]
+                except ValueError as e:
+                    self.logger.error(f"Skipping {src}. {e}")
+                    continue
+                self.logger.debug(f"Scored {src}.")
+        return rows
+
+    def snapshot_layout(self, raw_cols: tuple):
+        """
+        Return (raw positions, feature positions) mapping a snapshot layout to the feature vector.
+        Raises ValueError when the layout fails the control-plane or etcd checks.
+        """
+        if raw_cols not in self.layouts:
+            try:
+                names = self.normalized_names(list(raw_cols))
+            except ValueError as e:
+                # remembered so a repeated bad layout is rejected without building its plan again
+                self.layouts[raw_cols] = e
+                raise
+            pairs = [(pos, self.feature_index[name]) for pos, name in enumerate(names) if name in self.feature_index]
+            self.layouts[raw_cols] = (np.array([raw for raw, _ in pairs], dtype=np.intp),
+                                      np.array([feature for _, feature in pairs], dtype=np.intp))
+        layout = self.layouts[raw_cols]
+        if isinstance(layout, ValueError):
+            raise layout
+        return layout
+
+    def score_snapshot(self, record: dict):
+        """
+        Score one raw snapshot {raw column: value}. Returns {'y_pred': label, 'p_<label>': probability}.
+        Raises ValueError for a record that is not a mapping, fails the control-plane or etcd
+        checks or has non-numeric feature values.
+        """
+        if not isinstance(record, dict):
+            raise ValueError(f"Snapshot must be a {{column: value}} object, got {type(record).__name__}.")
+        raw_pos, feature_pos = self.snapshot_layout(tuple(record.keys()))
+        values = list(record.values())
+        vector = np.zeros((1, len(self.features)), dtype=np.float64)
+        # missing values (None/NaN) are 0 as in load_dataset
+        try:
+            vector[0, feature_pos] = np.nan_to_num(np.array([values[pos] for pos in raw_pos], dtype=np.float64))
+        except TypeError as e:
+            raise ValueError(f"Non-numeric feature value: {e}") from e
+        if self.fast_path is None:
+            return self.predictions(pd.DataFrame(vector, columns=self.features)).iloc[0].to_dict()
+
+        blocks, rest = self.fast_path
+        with warnings.catch_warnings():
+            # transformers were fit on named columns, the positions are resolved above
+            warnings.simplefilter("ignore", UserWarning)
+            Xt = np.hstack([vector[:, pos] if transformer == 'passthrough' else transformer.transform(vector[:, pos])
+                            for transformer, pos in blocks])
+            result = {'y_pred': self.labels[int(rest.predict(Xt)[0])]}
+            if self.proba:
+                for code, p in zip(self.pipeline.classes_, rest.predict_proba(Xt)[0]):
+                    result[f"p_{self.labels[int(code)]}"] = p
+        return result
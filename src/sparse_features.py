@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+from .file_utils import atomic_write
+
+class SparseFeatures:
+    """
+    CSR feature matrix of a wrangled DataFrame with its column metadata.
+
+    Most bool and uint32 columns (yy_* indicators, counters of absent nodes) are 0 after
+    fillna, so only the non-zero values are stored: memory and sparse-aware fits scale
+    with the number of non-zeros instead of the full width. columns and dtypes keep the
+    frame layout so column groups can be selected by name or dtype and to_frame restores
+    the DataFrame.
+    """
+    def __init__(self, matrix, columns, dtypes, index=None):
+        from scipy import sparse # imported on first use
+        self.matrix = sparse.csr_matrix(matrix)
+        self.columns = list(columns)
+        self.dtypes = dict(dtypes)
+        self.index = np.arange(self.matrix.shape[0]) if index is None else np.asarray(index)
+        self.positions = {colname: pos for pos, colname in enumerate(self.columns)}
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame):
+        """
+        Build the CSR matrix column by column from the non-zero values, without a dense copy
+        of the frame. Every column must be numeric or bool.
+        """
+        from scipy import sparse
+        rows, cols, data = [], [], []
+        for pos, colname in enumerate(df.columns):
+            if not (pd.api.types.is_numeric_dtype(df[colname]) or pd.api.types.is_bool_dtype(df[colname])):
+                raise ValueError(f"Column {colname} of dtype {df[colname].dtype} is not numeric.")
+            values = df[colname].to_numpy(dtype=np.float64)
+            nonzero = np.flatnonzero(values)
+            rows.append(nonzero)
+            cols.append(np.full(nonzero.shape[0], pos, dtype=np.int64))
+            data.append(values[nonzero])
+        matrix = sparse.coo_matrix((np.concatenate(data) if data else np.empty(0),
+                                    (np.concatenate(rows) if rows else np.empty(0, dtype=np.int64),
+                                     np.concatenate(cols) if cols else np.empty(0, dtype=np.int64))),
+                                   shape=df.shape).tocsr()
+        return cls(matrix, df.columns, {colname: str(dtype) for colname, dtype in df.dtypes.items()}, df.index)
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def nnz(self):
+        return self.matrix.nnz
+
+    def density(self):
+        return self.nnz / max(self.shape[0] * self.shape[1], 1)
+
+    def nbytes(self):
+        return self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes
+
+    def select_dtypes(self, include):
+        """
+        Return the positions of the columns whose dtype is a subtype of one of include
+        (numpy types, as DataFrame.select_dtypes)
+        """
+        return [pos for pos, colname in enumerate(self.columns)
+                if any(np.issubdtype(np.dtype(self.dtypes[colname]), kind) for kind in include)]
+
+    def block(self, cols):
+        """
+        Return the CSR matrix of cols (names or positions)
+        """
+        positions = [self.positions[colname] if isinstance(colname, str) else colname for colname in cols]
+        return self.matrix[:, positions]
+
+    def take(self, rows):
+        """
+        Return the rows at the given positions as a new SparseFeatures
+        """
+        rows = np.asarray(rows)
+        return SparseFeatures(self.matrix[rows], self.columns, self.dtypes, self.index[rows])
+
+    def to_frame(self):
+        """
+        Dense DataFrame with the original columns and dtypes
+        """
+        return pd.DataFrame(self.matrix.toarray(), columns=self.columns, index=self.index).astype(self.dtypes)
+
+    def save(self, path: str):
+        """
+        Store the matrix and its column metadata in one .npz file
+        """
+        with atomic_write(path, suffix=".tmp.npz") as tmp:
+            np.savez(tmp, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                     shape=np.array(self.shape), index=self.index, columns=np.array(self.columns, dtype=str),
+                     dtypes=np.array([self.dtypes[colname] for colname in self.columns], dtype=str))
+
+    @classmethod
+    def load(cls, path: str):
+        from scipy import sparse
+        with np.load(path) as stored:
+            matrix = sparse.csr_matrix((stored['data'], stored['indices'], stored['indptr']), shape=tuple(stored['shape']))
+            columns = stored['columns'].tolist()
+            return cls(matrix, columns, dict(zip(columns, stored['dtypes'].tolist())), stored['index'])
@@ -0,0 +1,210 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .config import Logger
+from .custom_ml import model_scores
+from .data_transformation import DataTransformation, DROP_COLUMNS
+from .deduplication import RowDeduplicator
+from .data_wrangling import DATE_PARTITION, open_wrangled_dataset
+
+# y_label codes used by CustomML.encode_y
+Y_CODES = {'green': 0, 'red': 1, 'yellow': 2}
+
+class StreamingML:
+    """
+    Out-of-core training over a wrangled Parquet file or partitioned dataset.
+
+    Batches are read from the Parquet row groups and go through the same steps as the
+    notebooks: impute_y_label, normalize_sources, the get_clean_dataset column drop and
+    hash-based row deduplication. The uint32 and float64 features are scaled per type
+    (as CustomML.feature_scaling_per_type) with scalers fit by partial_fit, then an
+    SGDClassifier (log loss, i.e. logistic regression) is trained with partial_fit.
+
+    Rows whose hash falls in the holdout fraction are never trained on and are used by
+    evaluate, so the split is the same on every pass and every run.
+    """
+    # scalers with partial_fit (sklearn is imported on first use, see make_scaler)
+    SCALERS = ('standard', 'maxabs', 'minmax')
+
+    def __init__(self, transformer: DataTransformation, label_weight=[0.02,0.01,0],
+                 scaler_uint32='standard', scaler_float64='standard', binary=True,
+                 holdout=0.25, batch_size=65536, dedup=True, random_state=42, logger=None):
+        self.logger = logger if logger else Logger(show_message=False).logger
+        for scaler in (scaler_uint32, scaler_float64):
+            if scaler not in self.SCALERS:
+                # PowerTransformer has no partial_fit
+                raise ValueError(f"Scaler {scaler} does not support incremental fitting. Use one of {list(self.SCALERS)}.")
+        self.transformer = transformer
+        self.label_weight = label_weight
+        self.scaler_names = (scaler_uint32, scaler_float64)
+        self.binary = binary
+        self.holdout = holdout
+        self.batch_size = batch_size
+        self.dedup = dedup
+        self.random_state = random_state
+        self.classes = np.array([0, 1] if binary else [0, 1, 2])
+
+        self.columns = None     # (uint32 columns, float64 columns) fixed on the first batch
+        self.scalers = None
+        self.model = None
+        self.class_counts = np.zeros(len(self.classes), dtype=np.int64)
+
+    def iter_batches(self, path: str):
+        """
+        Yield the wrangled dataset at path (file or hive-partitioned directory) as DataFrames
+        of at most batch_size rows. Partitions are read with the unified schema of all of them
+        and the columns they miss are 0 (False), as in the combined dataset.
+        """
+        dataset = open_wrangled_dataset(path)
+        columns = [name for name in dataset.schema.names if name != DATE_PARTITION]
+        for batch in dataset.to_batches(columns=columns, batch_size=self.batch_size):
+            if batch.num_rows:
+                yield self.fill_missing(batch).to_pandas()
+
+    @staticmethod
+    def fill_missing(batch):
+        """
+        Replace the nulls of the numeric and bool columns of batch with 0 (False), keeping
+        the column types
+        """
+        arrays = []
+        for array in batch.columns:
+            if array.null_count and (pa.types.is_integer(array.type) or pa.types.is_floating(array.type)
+                                     or pa.types.is_boolean(array.type)):
+                fill = False if pa.types.is_boolean(array.type) else 0
+                array = pc.fill_null(array, pa.scalar(fill, type=array.type))
+            arrays.append(array)
+        return pa.RecordBatch.from_arrays(arrays, schema=batch.schema)
+
+    def prepare(self, df, deduplicator=None):
+        """
+        Return (X, y, holdout) for one batch: the features by type, the encoded y_label
+        and the boolean mask of held-out rows
+        """
+        if 'y_label' not in df.columns:
+            df = self.transformer.impute_y_label(df, label_weight=self.label_weight)
+        if isinstance(df['source'].dtype, pd.CategoricalDtype):
+            df['source'] = df['source'].astype(str)
+        self.transformer.normalize_sources(df)
+        df = df[df.columns.drop(list(df.filter(regex=DROP_COLUMNS, axis=1)))]
+        if deduplicator is not None:
+            df = deduplicator.filter(df)
+
+        X = df.drop(['source','y_label'], axis=1)
+        if self.columns is None:
+            self.columns = (X.select_dtypes(include=[np.unsignedinteger]).columns.to_list(),
+                            X.select_dtypes(include=[np.floating]).columns.to_list())
+        # features missing from a batch (e.g. mno only nodes) are 0 as in the combined dataset
+        X = X.reindex(columns=self.columns[0] + self.columns[1], fill_value=0)
+
+        y = df['y_label'].astype(str).map(Y_CODES).to_numpy(dtype=np.int64)
+        if self.binary:
+            y = (y > 0).astype(np.int64)
+
+        # deterministic holdout from the row content
+        hashes = pd.util.hash_pandas_object(X, index=False).to_numpy()
+        holdout = (hashes % 10000) < int(self.holdout * 10000)
+        return X, y, holdout
+
+    def iter_prepared(self, path: str):
+        """
+        Yield (X, y, holdout) for every batch of path, deduplicating rows across batches
+        """
+        deduplicator = RowDeduplicator() if self.dedup else None
+        for df in self.iter_batches(path):
+            X, y, holdout = self.prepare(df, deduplicator)
+            if X.shape[0]:
+                yield X, y, holdout
+
+    def transform(self, X):
+        """
+        Scale the uint32 and float64 features with the fitted scalers, same column order
+        as the ColumnTransformer of CustomML.feature_scaling_per_type
+        """
+        blocks = [scaler.transform(X[cols].to_numpy(dtype=np.float64))
+                  for scaler, cols in zip(self.scalers, self.columns) if cols]
+        return np.hstack(blocks)
+
+    def make_scaler(self, scaler):
+        from sklearn.preprocessing import MaxAbsScaler, MinMaxScaler, StandardScaler
+        match scaler:
+            case 'standard':
+                return StandardScaler()
+            case 'maxabs':
+                return MaxAbsScaler()
+            case 'minmax':
+                return MinMaxScaler()
+            case _:
+                raise KeyError(scaler)
+
+    def fit_scalers(self, path: str):
+        """
+        First pass: fit the scalers and count the classes of the training rows
+        """
+        self.logger.debug("Fitting scalers.")
+        self.scalers = [self.make_scaler(name) for name in self.scaler_names]
+        self.class_counts[:] = 0
+        for X, y, holdout in self.iter_prepared(path):
+            train = ~holdout
+            if not train.any():
+                continue
+            for scaler, cols in zip(self.scalers, self.columns):
+                if cols:
+                    scaler.partial_fit(X.loc[train, cols].to_numpy(dtype=np.float64))
+            self.class_counts += np.bincount(y[train], minlength=len(self.classes))
+        self.logger.debug(f"Scalers fit on {self.class_counts.sum()} rows.")
+
+    def class_weight(self):
+        """
+        class_weight='balanced' from the class counts (SGDClassifier.partial_fit does not
+        accept 'balanced')
+        """
+        total = self.class_counts.sum()
+        return {int(label): total / (len(self.classes) * count) if count else 1.0
+                for label, count in zip(self.classes, self.class_counts)}
+
+    def fit(self, path: str, epochs=1):
+        """
+        Fit the scalers and train the classifier over path for the given number of epochs
+        """
+        from sklearn.linear_model import SGDClassifier
+        self.fit_scalers(path)
+        self.model = SGDClassifier(loss='log_loss', penalty='l2', class_weight=self.class_weight(),
+                                   random_state=self.random_state)
+        for epoch in range(epochs):
+            rows = 0
+            for X, y, holdout in self.iter_prepared(path):
+                train = ~holdout
+                if not train.any():
+                    continue
+                self.model.partial_fit(self.transform(X[train]), y[train], classes=self.classes)
+                rows += int(train.sum())
+            self.logger.info(f"Epoch {epoch+1}/{epochs} trained on {rows} rows.")
+        return self
+
+    def predict(self, X):
+        return self.model.predict(self.transform(X))
+
+    def evaluate(self, path: str, silent=False):
+        """
+        Score the classifier on the held-out rows of path with the CustomML.get_model_scores
+        metrics. Returns the scores with the confusion matrix.
+        """
+        from sklearn.metrics import confusion_matrix
+        y_truth = []
+        y_pred = []
+        for X, y, holdout in self.iter_prepared(path):
+            if holdout.any():
+                y_truth.append(y[holdout])
+                y_pred.append(self.predict(X[holdout]))
+        y_truth = np.concatenate(y_truth) if y_truth else np.array([], dtype=np.int64)
+        y_pred = np.concatenate(y_pred) if y_pred else np.array([], dtype=np.int64)
+
+        score_card = model_scores(y_truth, y_pred)
+        if not silent:
+            for s in score_card.keys():
+                print(f"{s:>25}\t{score_card[s]}")
+        score_card['confusion_matrix'] = confusion_matrix(y_truth, y_pred, labels=self.classes).tolist()
+        return score_card
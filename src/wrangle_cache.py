@@ -0,0 +1,68 @@
+import os
+import hashlib
+import pyarrow as pa
+from .manifest import Manifest
+from .file_utils import atomic_write
+
+class WrangleCache:
+    """
+    Content-addressed cache of wrangled per-file outputs.
+
+    Each entry is the fully wrangled table of one source, stored uncompressed in the
+    Arrow IPC (Feather v2) file format under a key derived from the source content hash
+    and the mapping and labels hashes, so a changed source or mapping never hits a stale
+    entry. Entries are memory-mapped on reload: numeric columns are not copied.
+    Source hashes are remembered in index.json (size and mtime) so unchanged sources
+    are not hashed again.
+
+    Only the process that owns the index writes it (save_index): parallel workers open the
+    cache with save_index=False after the parent recorded the sources (record), and hash
+    sources missing from the index in memory only.
+    """
+    def __init__(self, cache_dir: str, mapping_digest: str, labels_digest: str, save_index=True):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.digest = hashlib.sha256(f"{mapping_digest}:{labels_digest}".encode()).hexdigest()
+        self.index = Manifest(os.path.join(self.cache_dir, "index.json"), use_hash=True)
+        self.save_index = save_index
+
+    def record(self, file_names: list):
+        """
+        Hash the sources of file_names missing from the index and save it once
+        """
+        pending = [fname for fname in file_names if not self.index.is_current(fname, self.digest)]
+        for fname in pending:
+            self.index.update(fname, self.digest, [])
+        if pending and self.save_index:
+            self.index.save()
+
+    def key(self, fname: str, variant=""):
+        """
+        Cache key of fname; variant tells apart outputs of the same source (e.g. a column projection).
+        The file name is part of the key as the wrangled table embeds it in the source column.
+        """
+        if not self.index.is_current(fname, self.digest):
+            self.index.update(fname, self.digest, [])
+            if self.save_index:
+                self.index.save()
+        entry = self.index.entries[str(fname)]
+        source = os.path.basename(str(fname))
+        return hashlib.sha256(f"{entry['sha256']}:{self.digest}:{source}:{variant}".encode()).hexdigest()
+
+    def path(self, key: str):
+        return os.path.join(self.cache_dir, key + ".arrow")
+
+    def get(self, key: str):
+        """
+        Return the cached pyarrow.Table memory-mapped from disk, None when missing
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        # the table buffers keep the mapping alive
+        return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+    def put(self, key: str, table: pa.Table):
+        with atomic_write(self.path(key)) as tmp, pa.OSFile(tmp, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
@@ -0,0 +1,25 @@
+import os
+import sys
+import logging
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import SyntheticCollection
+from src.config import Config
+
+@pytest.fixture(scope="session")
+def config():
+    return Config(config_file=os.path.join(ROOT, "mapping/mapping.yaml"),
+                  y_map_file=os.path.join(ROOT, "mapping/labels-definition.yaml"),
+                  logger=logging.getLogger("tests"))
+
+@pytest.fixture(scope="session")
+def collection(tmp_path_factory):
+    """
+    Two small synthetic collection files, one mno and one compact
+    """
+    synthetic = SyntheticCollection(os.path.join(ROOT, "mapping/mapping.yaml"),
+                                    os.path.join(ROOT, "mapping/labels-definition.yaml"))
+    return synthetic.generate(str(tmp_path_factory.mktemp("collection")), files=2, rows=50)
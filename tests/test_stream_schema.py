@@ -0,0 +1,34 @@
+import logging
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src import data_wrangling
+from src.data_transformation import DROP_COLUMNS
+from src.data_wrangling import DataWrangle
+
+LABEL_WEIGHT = [0.02, 0.01, 0]
+
+def wrangler(config, dstdir):
+    return DataWrangle(config.config, config.y_map, logger=logging.getLogger("tests"), dstdir=str(dstdir))
+
+def test_stream_with_label_weight(config, collection, tmp_path):
+    dw = wrangler(config, tmp_path)
+    dw.stream_datasets(collection, "stream.parquet", batch_size=20, drop=DROP_COLUMNS, label_weight=LABEL_WEIGHT)
+    table = pq.read_table(tmp_path / "stream.parquet")
+    assert table.num_rows == 100
+    label_type = table.schema.field('y_label').type
+    assert pa.types.is_string(label_type) or pa.types.is_large_string(label_type)
+    assert set(table.column('y_label').to_pylist()) <= {'green', 'yellow', 'red'}
+
+def test_arrow_schema_object_label(config, tmp_path, monkeypatch):
+    # pandas < 3 stores 'str' as object, which has no Arrow type of its own
+    monkeypatch.setitem(data_wrangling.LABEL_DTYPES, 'y_label', 'object')
+    schema = wrangler(config, tmp_path).arrow_schema(['source', 'y_label', 'total_y_label_red'])
+    assert schema.field('y_label').type == pa.string()
+    assert schema.field('total_y_label_red').type == pa.uint32()
+
+def test_stream_with_object_label(config, collection, tmp_path, monkeypatch):
+    monkeypatch.setitem(data_wrangling.LABEL_DTYPES, 'y_label', 'object')
+    dw = wrangler(config, tmp_path)
+    dw.stream_datasets(collection, "stream.parquet", batch_size=20, drop=DROP_COLUMNS, label_weight=LABEL_WEIGHT)
+    assert pq.read_table(tmp_path / "stream.parquet").num_rows == 100